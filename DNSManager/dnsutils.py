@@ -14,7 +14,19 @@ import dns.reversename
 import dns.resolver
 import dns.edns
 import dns.zone
+import dns.message
+import dns.rdatatype
+import dns.rdataclass
+import dns.flags
+import dns.rcode
+import select
 import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from hashlib import sha256
 from dns.exception import DNSException, SyntaxError
 
 
@@ -30,9 +42,35 @@ class DynDNSException(Exception):
     pass
 
 
+class MasterUnavailable(DynDNSException):
+    """
+    Master is not contacted because recent operations on it have failed
+    """
+    pass
+
+
+class PrerequisiteFailed(DynDNSException):
+    """
+    Master refused update because its prerequisites were not satisfied
+    """
+    pass
+
+
 class DNSRecordException(Exception):
     pass
 
+# Seconds to wait for answer to single UDP query
+QUERY_TIMEOUT = 5
+
+# Seconds to wait for TCP connection to DNS-server
+CONNECT_TIMEOUT = 3
+
+# Seconds to wait for each read from DNS-server
+READ_TIMEOUT = QUERY_TIMEOUT
+
+# Seconds zone transfer may take in total, including connecting
+XFR_LIFETIME = 600
+
 keyTypes = {
     'HMAC_MD5': dns.tsig.HMAC_MD5,
     'HMAC_SHA1': dns.tsig.HMAC_SHA1,
@@ -60,8 +98,15 @@ DNS_RECORD_TYPES_WITH_PTR = [
     'AAAA'
 ]
 
+# Result of incremental zone transfer. If master sent whole zone instead
+# of differences, full is True and added contains every record of zone.
+ZoneDiff = namedtuple('ZoneDiff', ['serial', 'full', 'deleted', 'added'])
 
-def checkKey(key):
+# Parsed TSIG key
+TSIGKey = namedtuple('TSIGKey', ['keyring', 'algorithm'])
+
+
+def _parseKey(key):
     try:
         k = {key.rsplit(' ')[0]:key.rsplit(' ')[6]}
     except IndexError:
@@ -73,6 +118,80 @@ def checkKey(key):
     return KeyRing
 
 
+class KeyringCache(object):
+    """
+    Parsed TSIG keyrings and algorithms keyed by owner and hash of key.
+    Owner is usually id of Domain using the key, all keys of owner can
+    be dropped when it changes. Keys without owner would never be dropped,
+    parse them with parseKey instead.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, keyAlgorithm=None, owner=None):
+        """
+        :param key: TSIG key in DNS KEY record format
+        :param keyAlgorithm: TSIG key algorithm name, see keyTypes
+        :param owner: cache owner
+        :return: TSIGKey
+        """
+        digest = sha256(('%s %s' % (keyAlgorithm, key)).encode('utf-8')).hexdigest()
+        try:
+            value = self._keys[(owner, digest)]
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+        value = parseKey(key, keyAlgorithm)
+        with self._lock:
+            self._keys[(owner, digest)] = value
+        return value
+
+    def invalidate(self, owner):
+        with self._lock:
+            for cache_key in [x for x in self._keys if x[0] == owner]:
+                del self._keys[cache_key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._keys)}
+
+
+keyrings = KeyringCache()
+
+
+def parseKey(key, keyAlgorithm=None):
+    """
+    Parse TSIG key without caching it
+    :param key: TSIG key in DNS KEY record format
+    :param keyAlgorithm: TSIG key algorithm name, see keyTypes
+    :return: TSIGKey
+    """
+    algorithm = None
+    if keyAlgorithm is not None:
+        algorithm = getAlgorithm(keyAlgorithm)
+    return TSIGKey(_parseKey(key), algorithm)
+
+
+def checkKey(key):
+    # Keys typed to forms are not cached, only keys of saved domains are
+    return _parseKey(key)
+
+
+def prepareKey(key, keyAlgorithm):
+    """
+    :param key: TSIGKey or TSIG key in DNS KEY record format
+    :param keyAlgorithm: TSIG key algorithm name, not used with TSIGKey
+    :return: (KeyRing, algorithm) tuple
+    """
+    if isinstance(key, TSIGKey):
+        return key
+    return parseKey(key, keyAlgorithm)
+
+
 def getAlgorithm(keyType):
     return keyTypes[keyType]
 
@@ -85,13 +204,85 @@ def genPTR(Address):
     return a
 
 
+class ZoneFinder(object):
+    """
+    Find zone containing a name, used to find reverse zones for PTR records.
+
+    Name and its parents are looked up from known zones, so the longest
+    matching zone wins with one set lookup per label. Known zones are
+    returned by loader, for example zones of all domains, and loaded again
+    after local_ttl seconds or invalidate(). Only if no known zone matches,
+    zone is discovered from DNS with dns.resolver.zone_for_name and
+    remembered as known for ttl seconds.
+    """
+
+    def __init__(self, loader=None, local_ttl=60, ttl=3600):
+        self.loader = loader
+        self.local_ttl = local_ttl
+        self.ttl = ttl
+        self._local = None
+        self._local_expires = 0
+        self._discovered = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, name):
+        """
+        :param name: absolute dns.name.Name
+        :return: dns.name.Name of zone
+        """
+        zone = self._match(name)
+        if zone is not None:
+            self.hits += 1
+            return zone
+        self.misses += 1
+        zone = dns.resolver.zone_for_name(name)
+        with self._lock:
+            self._discovered[zone] = time.time() + self.ttl
+        return zone
+
+    def _match(self, name):
+        now = time.time()
+        local = self._local_zones(now)
+        while True:
+            if name in local or self._discovered.get(name, 0) > now:
+                return name
+            try:
+                name = name.parent()
+            except dns.name.NoParent:
+                return None
+
+    def _local_zones(self, now):
+        if self.loader is None:
+            return frozenset()
+        local = self._local
+        if local is None or self._local_expires <= now:
+            local = frozenset(dns.name.from_text(zone) for zone in self.loader())
+            self._local = local
+            self._local_expires = now + self.local_ttl
+        return local
+
+    def invalidate(self):
+        with self._lock:
+            self._local = None
+            self._discovered.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'known': len(self._local or ()), 'discovered': len(self._discovered)}
+
+
+zones = ZoneFinder()
+
+
 def parseName(Origin, Name):
     try:
         n = dns.name.from_text(Name)
     except:
         raise DynDNSException('Error: %s is not a valid name' % Name)
     if Origin is None:
-        Origin = dns.resolver.zone_for_name(n)
+        Origin = zones.find(n)
         Name = n.relativize(Origin)
         return Origin, Name
     else:
@@ -103,58 +294,380 @@ def parseName(Origin, Name):
         return Origin, Name
 
 
+class ChangeSet(object):
+    """
+    Collect any number of changes to one zone and send them to master
+    as a single signed UPDATE message (RFC 2136). Master applies all
+    changes or none of them.
+
+    Names are fully qualified names inside the zone. Changes and
+    prerequisites are also recorded as (action, name, ttl, type, data)
+    tuples, see operations() and load().
+    """
+
+    def __init__(self, Server, key, keyAlgorithm, Origin):
+        self.server = Server
+        self.origin = dns.name.from_text(Origin)
+        KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+        self.update = dns.update.Update(self.origin, keyring=KeyRing, keyalgorithm=keyAlgorithm)
+        self.prerequisites = []
+        self.changes = []
+
+    def __len__(self):
+        return len(self.changes)
+
+    def _name(self, name):
+        Origin, Name = parseName(self.origin.to_text(), name)
+        return Name
+
+    def add(self, name, ttl, type, data):
+        self.update.add(self._name(name), int(ttl), type, data)
+        self.changes.append(('add', name, int(ttl), type, data))
+
+    def delete(self, name, type=None, data=None):
+        """
+        Delete record, whole rrset if data is not given or all records
+        of name if type is not given either.
+        """
+        args = [x for x in (type, data) if x is not None]
+        self.update.delete(self._name(name), *args)
+        self.changes.append(('delete', name, None, type, data))
+
+    def replace(self, name, ttl, type, data):
+        self.update.replace(self._name(name), int(ttl), type, data)
+        self.changes.append(('update', name, int(ttl), type, data))
+
+    def apply(self, Action, name, ttl, type, data):
+        if Action == 'add':
+            self.add(name, ttl, type, data)
+        elif Action == 'delete' or Action == 'del':
+            self.delete(name, type, data)
+        elif Action == 'update':
+            self.replace(name, ttl, type, data)
+        elif Action == 'present':
+            self.present(name, type, data)
+        elif Action == 'absent':
+            self.absent(name, type)
+        else:
+            raise DynDNSException("Unknown action %s" % Action)
+
+    def present(self, name, type=None, data=None):
+        """
+        Prerequisite: name, rrset of type or record exists
+        """
+        args = [x for x in (type, data) if x is not None]
+        self.update.present(self._name(name), *args)
+        self.prerequisites.append(('present', name, None, type, data))
+
+    def absent(self, name, type=None):
+        """
+        Prerequisite: name or rrset of type does not exist
+        """
+        self.update.absent(self._name(name), type)
+        self.prerequisites.append(('absent', name, None, type, None))
+
+    def operations(self):
+        """
+        :return: list of (action, name, ttl, type, data) tuples, prerequisites first
+        """
+        return self.prerequisites + self.changes
+
+    def load(self, operations):
+        """
+        Add operations returned by operations() of another ChangeSet
+        """
+        for (Action, name, ttl, type, data) in operations:
+            self.apply(Action, name, ttl, type, data)
+
+    def send(self):
+        send_changesets([self])
+
+    def check_response(self, Response):
+        rcode = dns.rcode.to_text(Response.rcode())
+        logger.info('Sending %d changes to zone %s resulted in: %s' % (len(self.changes), self.origin, rcode))
+        if rcode in ('YXDOMAIN', 'YXRRSET', 'NXDOMAIN', 'NXRRSET'):
+            raise PrerequisiteFailed('ERROR: Prerequisites of %d changes to zone %s failed: %s' % (
+                                     len(self.changes), self.origin, rcode))
+        if rcode != 'NOERROR':
+            raise DynDNSException('ERROR: Sending %d changes to zone %s resulted in: %s' % (
+                                  len(self.changes), self.origin, rcode))
+
+
+def send_changesets(changesets):
+    """
+    Send changesets, pipelining ones going to same server over one
+    pooled connection.
+    :param changesets: list of ChangeSet objects
+    """
+    by_server = {}
+    for changeset in changesets:
+        if changeset.changes:
+            by_server.setdefault(changeset.server, []).append(changeset)
+    for server, pending in by_server.items():
+        try:
+            with breakers.guard(server):
+                responses = connections.query_many([x.update for x in pending], get_address(server))
+        except dns.tsig.PeerBadKey:
+            raise DynDNSException('ERROR: The server is refusing our key')
+        for changeset, Response in zip(pending, responses):
+            changeset.check_response(Response)
+
+
+class _ConnectionClosed(Exception):
+    """
+    Server closed or reset connection before sending any response bytes
+    """
+
+
+class ConnectionPool(object):
+    """
+    Persistent TCP connections to DNS-servers keyed by address and port.
+
+    Messages are framed with two byte length prefix (RFC 1035 4.2.2), so
+    any number of messages can be sent over one connection. Idle
+    connections are closed after idle_timeout seconds and checked before
+    reuse. If server closes or resets reused connection before answering
+    anything, messages are sent again over a new connection. Messages are
+    never sent again after a timeout, server may have applied them already.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=30, timeout=READ_TIMEOUT, connect_timeout=CONNECT_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def query(self, message, address, port=53):
+        return self.query_many([message], address, port)[0]
+
+    def query_many(self, messages, address, port=53):
+        """
+        Send messages pipelined over one connection
+        :return: list of responses in same order as messages
+        """
+        key = (address, port)
+        while True:
+            sock, reused = self._acquire(key)
+            try:
+                responses = self._exchange(sock, messages)
+            except _ConnectionClosed:
+                sock.close()
+                if reused:
+                    # Server closed idle connection, try again with new one
+                    continue
+                raise EOFError
+            except Exception:
+                sock.close()
+                raise
+            self._release(key, sock)
+            return responses
+
+    def _acquire(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                sock, last_used = idle.pop()
+                if now - last_used < self.idle_timeout and self._healthy(sock):
+                    return sock, True
+                sock.close()
+        sock = socket.create_connection(key, timeout=self.connect_timeout)
+        sock.settimeout(self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def _release(self, key, sock):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((sock, time.time()))
+                return
+        sock.close()
+
+    @staticmethod
+    def _healthy(sock):
+        # Idle connection should have nothing to read, readable socket
+        # means that server has closed or reset it.
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (ValueError, socket.error):
+            return False
+        return not readable
+
+    def _exchange(self, sock, messages):
+        wires = [message.to_wire() for message in messages]
+        sock.sendall(b''.join([struct.pack('!H', len(wire)) + wire for wire in wires]))
+        try:
+            first = sock.recv(2)
+        except ConnectionResetError:
+            raise _ConnectionClosed()
+        if not first:
+            raise _ConnectionClosed()
+        header = first + self._read(sock, 2 - len(first))
+        # Server may answer pipelined messages in any order
+        answers = {}
+        for _ in messages:
+            if header is None:
+                header = self._read(sock, 2)
+            (length,) = struct.unpack('!H', header)
+            header = None
+            wire = self._read(sock, length)
+            answers[struct.unpack('!H', wire[:2])[0]] = wire
+        responses = []
+        for message in messages:
+            if message.id not in answers:
+                raise dns.query.BadResponse
+            response = dns.message.from_wire(answers[message.id], keyring=message.keyring,
+                                             request_mac=message.mac)
+            if not message.is_response(response):
+                raise dns.query.BadResponse
+            responses.append(response)
+        return responses
+
+    @staticmethod
+    def _read(sock, count):
+        data = b''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+
+connections = ConnectionPool()
+
+
+# Errors which mean that DNS-server could not be reached or did not answer properly
+NETWORK_ERRORS = (DNSException, socket.error, EOFError)
+
+# Errors which mean that DNS-server could not be reached at all
+UNREACHABLE_ERRORS = (dns.exception.Timeout, socket.error, EOFError)
+
+
+class CircuitBreaker(object):
+    """
+    Stop contacting DNS-servers which keep failing.
+
+    Only errors of reaching the server count as failures, errors about
+    single zone, like refused transfer, do not. After threshold
+    consecutive failures of operations on a server its
+    breaker opens and operations fail immediately with MasterUnavailable.
+    After reset_timeout seconds one operation is let through. If it
+    succeeds the breaker closes, otherwise it stays open for another
+    reset_timeout.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def guard(self, server, errors=UNREACHABLE_ERRORS):
+        """
+        Run operation on server, counting errors of given types as failures
+        :raises MasterUnavailable: if breaker of server is open
+        """
+        self.check(server)
+        try:
+            yield
+        except errors:
+            self.failure(server)
+            raise
+        self.success(server)
+
+    def check(self, server):
+        now = time.time()
+        with self._lock:
+            opened = self._opened.get(server)
+            if opened is None:
+                return
+            if now - opened < self.reset_timeout:
+                raise MasterUnavailable('ERROR: %s is unavailable after %d failures, retrying in %d seconds' % (
+                                        server, self._failures[server], self.reset_timeout - (now - opened)))
+            # Let this operation try, others wait for its result
+            self._opened[server] = now
+
+    def success(self, server):
+        with self._lock:
+            if server in self._opened:
+                logger.info("%s is available again" % server)
+            self._failures.pop(server, None)
+            self._opened.pop(server, None)
+
+    def failure(self, server):
+        with self._lock:
+            failures = self._failures.get(server, 0) + 1
+            self._failures[server] = failures
+            if failures >= self.threshold:
+                if server not in self._opened:
+                    logger.warning("%s failed %d times, not contacting it for %d seconds" % (
+                                   server, failures, self.reset_timeout))
+                self._opened[server] = time.time()
+
+    def is_open(self, server):
+        """
+        :return: True if operations on server currently fail immediately
+        """
+        opened = self._opened.get(server)
+        return opened is not None and time.time() - opened < self.reset_timeout
+
+    def stats(self):
+        return {'open': sorted(x for x in list(self._opened) if self.is_open(x)),
+                'failing': dict(self._failures)}
+
+
+breakers = CircuitBreaker()
+
+
+def configure(connect_timeout=None, read_timeout=None, xfr_lifetime=None,
+              breaker_threshold=None, breaker_reset_timeout=None):
+    """
+    Change timeouts and circuit breaker limits, None keeps current value
+    """
+    global CONNECT_TIMEOUT, READ_TIMEOUT, XFR_LIFETIME
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connections.connect_timeout = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = connections.timeout = read_timeout
+    if xfr_lifetime is not None:
+        XFR_LIFETIME = xfr_lifetime
+    if breaker_threshold is not None:
+        breakers.threshold = breaker_threshold
+    if breaker_reset_timeout is not None:
+        breakers.reset_timeout = breaker_reset_timeout
+
+
 def doUpdate(Server, key, keyAlgorithm, Origin, doPTR, Action, TTL, Type, client, target):
+    # Do the update
+    send_changesets(updateChangesets(Server, key, keyAlgorithm, Origin, doPTR, Action, TTL, Type, client, target))
+
+
+def updateChangesets(Server, key, keyAlgorithm, Origin, doPTR, Action, TTL, Type, client, target):
+    """
+    Build changesets for doUpdate, forward zone first and reverse zone
+    second if doPTR is True.
+    :return: list of ChangeSet objects
+    """
     # Get the hostname and the origin
     TTL = dns.ttl.from_text(TTL)
     Origin, Name = parseName(Origin, client)
-    # Validate and setup the Key
-    KeyRing = checkKey(key)
-    # Start constructing the DDNS Query
-
-    keyAlgorithm = getAlgorithm(keyAlgorithm)
-
-    Update = dns.update.Update(Origin, keyring=KeyRing, keyalgorithm=keyAlgorithm)
-    # Put the payload together.
-    if Type in DNS_RECORD_TYPES_WITH_PTR:
-        myPayload = target
-        if doPTR == True:
-            ptrTarget = Name.to_text() + '.' + Origin.to_text()
-            ptrOrigin, ptrName = parseName(None, genPTR(myPayload).to_text())
-            ptrUpdate = dns.update.Update(ptrOrigin, keyring=KeyRing, keyalgorithm=keyAlgorithm)
-    elif Type in DNS_RECORD_TYPES:
-        myPayload = target
-        do_PTR = False
-    else:
+    if Type not in DNS_RECORD_TYPES:
         raise DynDNSException("Unknown type %s" % Type)
-    # Build the update
-    if Action == 'add':
-        Update.add(Name, TTL, Type, myPayload)
-        if doPTR == True:
-            ptrUpdate.add(ptrName, TTL, 'PTR', ptrTarget)
-    elif Action == 'delete' or Action == 'del':
-        Update.delete(Name, Type, myPayload)
-        if doPTR == True:
-            ptrUpdate.delete(ptrName, 'PTR', ptrTarget)
-    elif Action == 'update':
-        Update.replace(Name, TTL, Type, myPayload)
-        if doPTR == True:
-            ptrUpdate.replace(ptrName, TTL, 'PTR', ptrTarget)
-    else:
-        raise DynDNSException("Unknown action %s" % Action)
-    # Do the update
-    try:
-        Response = dns.query.tcp(Update, Server)
-    except dns.tsig.PeerBadKey:
-        raise DynDNSException('ERROR: The server is refusing our key')
-    logger.info('Creating %s record for %s resulted in: %s' % (Type, Name, dns.rcode.to_text(Response.rcode())))
-    if dns.rcode.to_text(Response.rcode()) != 'NOERROR':
-        raise DynDNSException('ERROR: Creating %s record for %s resulted in: %s' % (Type, Name, dns.rcode.to_text(Response.rcode())))
-    if doPTR == True:
-        try:
-            ptrResponse = dns.query.tcp(ptrUpdate, Server)
-        except dns.tsig.PeerBadKey:
-            raise DynDNSException('ERROR: The server is refusing our key')
-        logger.info('Creating PTR record for %s resulted in: %s' % (Name, dns.rcode.to_text(Response.rcode())))
+    Update = ChangeSet(Server, key, keyAlgorithm, Origin.to_text())
+    Update.apply(Action, client, TTL, Type, target)
+    ptrUpdate = None
+    if doPTR == True and Type in DNS_RECORD_TYPES_WITH_PTR:
+        ptrTarget = Name.to_text() + '.' + Origin.to_text()
+        ptrOrigin, ptrName = parseName(None, genPTR(target).to_text())
+        ptrUpdate = ChangeSet(Server, key, keyAlgorithm, ptrOrigin.to_text())
+        ptrUpdate.apply(Action, genPTR(target).to_text(), TTL, 'PTR', ptrTarget)
+    return [x for x in (Update, ptrUpdate) if x is not None]
 
 
 def axfr(Server, key, keyAlgorithm, Origin):
@@ -165,49 +678,308 @@ def axfr(Server, key, keyAlgorithm, Origin):
     :param Origin: domain
     :return: List of dns-records
     """
-    KeyRing = checkKey(key)
-    keyAlgorithm = getAlgorithm(keyAlgorithm)
-    zone = dns.zone.from_xfr(dns.query.xfr(Server, Origin, keyring=KeyRing, keyalgorithm=keyAlgorithm))
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    with breakers.guard(Server):
+        zone = dns.zone.from_xfr(dns.query.xfr(get_address(Server), Origin, keyring=KeyRing, keyalgorithm=keyAlgorithm,
+                                               timeout=READ_TIMEOUT, lifetime=XFR_LIFETIME))
     return zone
 
 
-def get_ipv4(address):
+def axfr_records(Server, key, keyAlgorithm, Origin):
+    """
+    Transfer zone without building dns.zone.Zone of it.
+    Records are yielded as response messages arrive.
+    :param Server: DNS-server
+    :param key: TSIG key
+    :param keyAlgorithm: TSIG key algorithm
+    :param Origin: domain
+    :return: generator of (name, ttl, class, type, data) tuples, name relative to origin
+    """
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    soa_seen = False
+    with breakers.guard(Server):
+        for message in dns.query.xfr(get_address(Server), Origin, keyring=KeyRing, keyalgorithm=keyAlgorithm,
+                                     timeout=READ_TIMEOUT, lifetime=XFR_LIFETIME):
+            for rrset in message.answer:
+                if _is_soa(rrset):
+                    # Transfer ends with the same SOA it started with
+                    if soa_seen:
+                        continue
+                    soa_seen = True
+                for record in _rrset_records(rrset):
+                    yield record
+
+
+def ixfr(Server, key, keyAlgorithm, Origin, serial):
+    """
+    Incremental zone transfer (RFC 1995) starting from serial.
+    Records are (name, ttl, class, type, data) tuples, name relative to
+    origin. Deleted and added sets contain net changes over all
+    difference sequences sent by master.
+    :param Server: DNS-server
+    :param key: TSIG key
+    :param keyAlgorithm: TSIG key algorithm
+    :param Origin: domain
+    :param serial: SOA serial of current copy of zone
+    :return: ZoneDiff
+    """
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    rrsets = []
+    with breakers.guard(Server):
+        for message in dns.query.xfr(get_address(Server), Origin, rdtype=dns.rdatatype.IXFR, serial=serial,
+                                     keyring=KeyRing, keyalgorithm=keyAlgorithm,
+                                     timeout=READ_TIMEOUT, lifetime=XFR_LIFETIME):
+            rrsets.extend(message.answer)
+
+    new_serial = rrsets[0][0].serial
+    if len(rrsets) == 1:
+        # Already up to date
+        return ZoneDiff(new_serial, False, set(), set())
+
+    if not _is_soa(rrsets[1]):
+        # Master sent whole zone, last SOA is the same as the first one
+        added = set()
+        for rrset in rrsets[:-1]:
+            added.update(_rrset_records(rrset))
+        return ZoneDiff(new_serial, True, set(), added)
+
+    # Sequences of old SOA, deleted records, new SOA, added records
+    deleted = set()
+    added = set()
+    deleting = False
+    for rrset in rrsets[1:-1]:
+        if _is_soa(rrset):
+            deleting = not deleting
+        for record in _rrset_records(rrset):
+            if deleting:
+                if record in added:
+                    added.discard(record)
+                else:
+                    deleted.add(record)
+            else:
+                if record in deleted:
+                    deleted.discard(record)
+                else:
+                    added.add(record)
+    return ZoneDiff(new_serial, False, deleted, added)
+
+
+def _is_soa(rrset):
+    return rrset.rdtype == dns.rdatatype.SOA and rrset.name == dns.name.empty
+
+
+def _rrset_records(rrset):
+    """
+    Flatten relativized rrset into (name, ttl, class, type, data) tuples
+    """
+    name = rrset.name.to_text()
+    if name == '@':
+        name = ''
+    rclass = dns.rdataclass.to_text(rrset.rdclass)
+    rtype = dns.rdatatype.to_text(rrset.rdtype)
+    for rdata in rrset:
+        yield (name, rrset.ttl, rclass, rtype, rdata.to_text())
+
+
+def soa_serial(Server, key, keyAlgorithm, Origin):
+    """
+    Query current SOA serial of zone from master using single UDP query.
+    :param Server: DNS-server
+    :param key: TSIG key
+    :param keyAlgorithm: TSIG key algorithm
+    :param Origin: domain
+    :return: SOA serial as int
+    """
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    Origin = dns.name.from_text(Origin)
+    query = dns.message.make_query(Origin, dns.rdatatype.SOA)
+    query.use_tsig(KeyRing, algorithm=keyAlgorithm)
+    with breakers.guard(Server):
+        address = get_address(Server)
+        response = dns.query.udp(query, address, timeout=READ_TIMEOUT)
+        if response.flags & dns.flags.TC:
+            response = dns.query.tcp(query, address, timeout=READ_TIMEOUT)
+    if response.rcode() != dns.rcode.NOERROR:
+        raise DynDNSException('ERROR: SOA query for %s resulted in: %s' % (Origin, dns.rcode.to_text(response.rcode())))
     try:
-        res = socket.getaddrinfo(address, 80, socket.AF_INET)
-    except socket.gaierror:
-        return []
-    out = []
-    for x in res:
-        if x[4][0] not in res:
-            out.append(x[4][0])
-    return out
+        rrset = response.find_rrset(response.answer, Origin, dns.rdataclass.IN, dns.rdatatype.SOA)
+    except KeyError:
+        raise DynDNSException('ERROR: %s did not return SOA record for %s' % (Server, Origin))
+    return rrset[0].serial
+
+
+class AddressCache(object):
+    """
+    Addresses of DNS-servers by name, addresses this host has a route to
+    first, IPv6 before IPv4 among those.
+
+    Names are resolved with A and AAAA queries and cached for the TTL of
+    the answers, limited to min_ttl..max_ttl seconds. Names not found in
+    DNS, for example ones in /etc/hosts, are resolved with getaddrinfo and
+    cached for default_ttl seconds. Names which cannot be resolved at all
+    are cached for negative_ttl seconds. With refresh, names are resolved
+    again in background when less than a quarter of TTL is left, so
+    callers do not wait for resolving.
+    """
+
+    def __init__(self, min_ttl=30, max_ttl=3600, default_ttl=300, negative_ttl=30, refresh=True):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+        self._addresses = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._resolver = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        """
+        :param name: DNS-server name or address
+        :return: list of addresses, empty if name cannot be resolved
+        """
+        found = self.cached(name)
+        if found is not None:
+            return found
+        self.misses += 1
+        return self._update(name)
+
+    def cached(self, name):
+        """
+        Like get, but never resolves in calling thread
+        :return: list of addresses or None if name is not cached
+        """
+        if is_valid_ipv4_address(name) or is_valid_ipv6_address(name):
+            return [name]
+        now = time.time()
+        entry = self._addresses.get(name)
+        if entry is None or entry[1] <= now:
+            return None
+        self.hits += 1
+        addresses, expires, ttl = entry
+        if self.refresh and addresses and expires - now < ttl / 4:
+            self._start_refresh(name)
+        return addresses
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._addresses.clear()
+            else:
+                self._addresses.pop(name, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._addresses)}
+
+    def _start_refresh(self, name):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+        thread = threading.Thread(target=self._refresh, args=(name,))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, name):
+        try:
+            self._update(name)
+        except Exception:
+            logger.exception("Refreshing address of %s failed" % name)
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def _update(self, name):
+        addresses, ttl = self._resolve(name)
+        if not addresses:
+            ttl = self.negative_ttl
+        with self._lock:
+            self._addresses[name] = (addresses, time.time() + ttl, ttl)
+        return addresses
+
+    def _resolve(self, name):
+        """
+        :return: (list of addresses, ttl)
+        """
+        if self._resolver is None:
+            self._resolver = dns.resolver.Resolver()
+            self._resolver.lifetime = QUERY_TIMEOUT
+        addresses = []
+        ttl = self.max_ttl
+        for rdtype in ('AAAA', 'A'):
+            try:
+                answer = self._resolver.query(name, rdtype)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                continue
+            except DNSException as e:
+                logger.info("Resolving %s %s failed, using system resolver: %s" % (name, rdtype, e))
+                addresses = []
+                break
+            addresses.extend(rdata.address for rdata in answer if rdata.address not in addresses)
+            ttl = min(ttl, answer.rrset.ttl)
+        if addresses:
+            ttl = max(self.min_ttl, ttl)
+        else:
+            # System order, which already accounts for configured address families
+            addresses, ttl = _getaddrinfo(name, socket.AF_UNSPEC), self.default_ttl
+        # Stable sort, so IPv6 stays first when the host has IPv6 connectivity
+        addresses.sort(key=lambda address: not _routable(address))
+        return addresses, ttl
+
+
+addresses = AddressCache()
+
+
+def get_address(address):
+    """
+    Return ip-address for DNS-server name or address
+    """
+    found = addresses.get(address)
+    if not found:
+        raise DynDNSException('Error: cannot resolve address for %s' % address)
+    return found[0]
+
+
+def get_ipv4(address):
+    return _getaddrinfo(address, socket.AF_INET)
 
 
 def get_ipv6(address):
+    return _getaddrinfo(address, socket.AF_INET6)
+
+
+def _routable(address):
+    """
+    Check if this host has a route to address. Connecting an UDP socket
+    sends nothing, but fails if there is no route, e.g. to IPv6 addresses
+    on IPv4-only hosts.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
     try:
-        res = socket.getaddrinfo(address, 80, socket.AF_INET6)
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect((address, 53))
+    except OSError:
+        return False
+    return True
+
+
+def _getaddrinfo(address, family):
+    try:
+        res = socket.getaddrinfo(address, 53, family)
     except socket.gaierror:
         return []
     out = []
     for x in res:
-        if x[4][0] not in res:
+        if x[4][0] not in out:
             out.append(x[4][0])
     return out
 
 
 def do_resolve(key, type, server):
-    server = get_ipv6(server) + get_ipv4(server)
-    try:
-        r = dns.resolver.Resolver(configure=False)
-        r.nameservers = server
-        responses = r.query(qname=key, rdtype=type)
-        out = []
-        if responses is not None:
-            for response in responses:
-               out.append(response.to_text())
-        return out
-    except DNSException:
-        return []
+    import dnsutils_async
+    return dnsutils_async.run(dnsutils_async.do_resolve(key, type, server))
 
 
 def is_valid_ipv4_address(address):
@@ -0,0 +1,263 @@
+# encoding: utf-8
+
+"""
+Asyncio counterparts of dnsutils DNS operations
+
+One event loop can drive hundreds of concurrent updates, resolves and
+transfers against different masters. Synchronous callers can use
+dnsutils or run coroutines with run().
+"""
+
+import asyncio
+import socket
+import struct
+import logging
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rdataclass
+import dns.rdatatype
+import dns.rcode
+import dns.tsig
+
+import dnsutils
+from dnsutils import DynDNSException, NETWORK_ERRORS, UNREACHABLE_ERRORS, breakers, prepareKey, updateChangesets, \
+    _is_soa, _rrset_records
+
+
+logger = logging.getLogger('dns')
+
+ASYNC_NETWORK_ERRORS = NETWORK_ERRORS + (asyncio.TimeoutError,)
+
+# Errors counted as failures of DNS-server by circuit breaker
+ASYNC_UNREACHABLE_ERRORS = UNREACHABLE_ERRORS + (asyncio.TimeoutError,)
+
+
+def run(coroutine):
+    """
+    Run coroutine to completion on a private event loop
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def udp(message, Server, port=53, timeout=None):
+    """
+    Send query using UDP, retry using TCP if answer is truncated
+    :param timeout: seconds to wait for answer, defaults to dnsutils.READ_TIMEOUT
+    :return: dns.message.Message
+    """
+    timeout = timeout or dnsutils.READ_TIMEOUT
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _UDPProtocol(future),
+                                                       remote_addr=(Server, port))
+    try:
+        transport.sendto(message.to_wire())
+        wire = await asyncio.wait_for(future, timeout)
+    finally:
+        transport.close()
+    response = dns.message.from_wire(wire, keyring=message.keyring, request_mac=message.mac)
+    if not message.is_response(response):
+        raise dns.query.BadResponse
+    if response.flags & dns.flags.TC:
+        return await tcp(message, Server, port, timeout)
+    return response
+
+
+async def tcp(message, Server, port=53, timeout=None):
+    """
+    Send message using TCP
+    :param timeout: seconds to wait for answer, defaults to dnsutils.READ_TIMEOUT
+    :return: dns.message.Message
+    """
+    timeout = timeout or dnsutils.READ_TIMEOUT
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(Server, port), dnsutils.CONNECT_TIMEOUT)
+    try:
+        _write_message(writer, message.to_wire())
+        await writer.drain()
+        wire = await asyncio.wait_for(_read_message(reader), timeout)
+    finally:
+        writer.close()
+    response = dns.message.from_wire(wire, keyring=message.keyring, request_mac=message.mac)
+    if not message.is_response(response):
+        raise dns.query.BadResponse
+    return response
+
+
+def _write_message(writer, wire):
+    writer.write(struct.pack('!H', len(wire)) + wire)
+
+
+async def _read_message(reader):
+    (length,) = struct.unpack('!H', await reader.readexactly(2))
+    return await reader.readexactly(length)
+
+
+async def send_changeset(changeset, timeout=None):
+    """
+    Send dnsutils.ChangeSet to its master
+    """
+    if not changeset.changes:
+        return
+    try:
+        with breakers.guard(changeset.server, ASYNC_UNREACHABLE_ERRORS):
+            Response = await tcp(changeset.update, await get_address(changeset.server), timeout=timeout)
+    except dns.tsig.PeerBadKey:
+        raise DynDNSException('ERROR: The server is refusing our key')
+    changeset.check_response(Response)
+
+
+async def doUpdate(Server, key, keyAlgorithm, Origin, doPTR, Action, TTL, Type, client, target):
+    """
+    Same as dnsutils.doUpdate, forward and PTR updates are sent concurrently
+    """
+    changesets = updateChangesets(Server, key, keyAlgorithm, Origin, doPTR, Action, TTL, Type, client, target)
+    await asyncio.gather(*[send_changeset(changeset) for changeset in changesets])
+
+
+async def soa_serial(Server, key, keyAlgorithm, Origin):
+    """
+    Same as dnsutils.soa_serial
+    """
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    Origin = dns.name.from_text(Origin)
+    query = dns.message.make_query(Origin, dns.rdatatype.SOA)
+    query.use_tsig(KeyRing, algorithm=keyAlgorithm)
+    with breakers.guard(Server, ASYNC_UNREACHABLE_ERRORS):
+        response = await udp(query, await get_address(Server))
+    if response.rcode() != dns.rcode.NOERROR:
+        raise DynDNSException('ERROR: SOA query for %s resulted in: %s' % (Origin, dns.rcode.to_text(response.rcode())))
+    try:
+        rrset = response.find_rrset(response.answer, Origin, dns.rdataclass.IN, dns.rdatatype.SOA)
+    except KeyError:
+        raise DynDNSException('ERROR: %s did not return SOA record for %s' % (Server, Origin))
+    return rrset[0].serial
+
+
+async def axfr_records(Server, key, keyAlgorithm, Origin, timeout=None):
+    """
+    Same as dnsutils.axfr_records, as asynchronous generator
+    """
+    with breakers.guard(Server, ASYNC_UNREACHABLE_ERRORS):
+        async for record in _axfr_records(Server, key, keyAlgorithm, Origin, timeout or dnsutils.READ_TIMEOUT):
+            yield record
+
+
+async def _axfr_records(Server, key, keyAlgorithm, Origin, timeout):
+    KeyRing, keyAlgorithm = prepareKey(key, keyAlgorithm)
+    Origin = dns.name.from_text(Origin)
+    query = dns.message.make_query(Origin, dns.rdatatype.AXFR)
+    query.use_tsig(KeyRing, algorithm=keyAlgorithm)
+    address = await get_address(Server)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(address, 53), dnsutils.CONNECT_TIMEOUT)
+    try:
+        _write_message(writer, query.to_wire())
+        await writer.drain()
+        tsig_ctx = None
+        first = True
+        soa_seen = False
+        done = False
+        while not done:
+            wire = await asyncio.wait_for(_read_message(reader), timeout)
+            message = dns.message.from_wire(wire, keyring=query.keyring, request_mac=query.mac,
+                                            xfr=True, origin=Origin, tsig_ctx=tsig_ctx,
+                                            multi=True, first=first)
+            tsig_ctx = message.tsig_ctx
+            if first and (not message.answer or not _is_soa(message.answer[0])):
+                raise dns.exception.FormError("first RRset is not an SOA")
+            first = False
+            for rrset in message.answer:
+                if _is_soa(rrset):
+                    # Transfer ends with the same SOA it started with
+                    if soa_seen:
+                        done = True
+                        continue
+                    soa_seen = True
+                for record in _rrset_records(rrset):
+                    yield record
+    finally:
+        writer.close()
+
+
+async def get_address(address):
+    """
+    Same as dnsutils.get_address, resolving in executor only if not cached
+    """
+    found = await get_addresses(address)
+    if not found:
+        raise DynDNSException('Error: cannot resolve address for %s' % address)
+    return found[0]
+
+
+async def get_addresses(address):
+    """
+    :return: addresses of DNS-server from dnsutils.addresses cache
+    """
+    found = dnsutils.addresses.cached(address)
+    if found is not None:
+        return found
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, dnsutils.addresses.get, address)
+
+
+async def get_ipv4(address):
+    return await _getaddrinfo(address, socket.AF_INET)
+
+
+async def get_ipv6(address):
+    return await _getaddrinfo(address, socket.AF_INET6)
+
+
+async def _getaddrinfo(address, family):
+    loop = asyncio.get_event_loop()
+    try:
+        res = await loop.getaddrinfo(address, 53, family=family)
+    except socket.gaierror:
+        return []
+    out = []
+    for x in res:
+        if x[4][0] not in out:
+            out.append(x[4][0])
+    return out
+
+
+async def do_resolve(key, type, server):
+    """
+    Query records of key directly from server
+    :return: list of record data strings
+    """
+    query = dns.message.make_query(key, type)
+    for address in await get_addresses(server):
+        try:
+            response = await udp(query, address)
+        except ASYNC_NETWORK_ERRORS:
+            continue
+        if response.rcode() != dns.rcode.NOERROR:
+            return []
+        try:
+            rrset = response.find_rrset(response.answer, dns.name.from_text(key), dns.rdataclass.IN,
+                                        dns.rdatatype.from_text(type))
+        except KeyError:
+            return []
+        return [rdata.to_text() for rdata in rrset]
+    return []
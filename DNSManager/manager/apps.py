@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+import dnsutils
+
+
+class ManagerConfig(AppConfig):
+    name = 'manager'
+
+    def ready(self):
+        dnsutils.configure(connect_timeout=getattr(settings, 'DNS_CONNECT_TIMEOUT', None),
+                           read_timeout=getattr(settings, 'DNS_READ_TIMEOUT', None),
+                           xfr_lifetime=getattr(settings, 'DNS_XFR_LIFETIME', None),
+                           breaker_threshold=getattr(settings, 'DNS_BREAKER_THRESHOLD', None),
+                           breaker_reset_timeout=getattr(settings, 'DNS_BREAKER_RESET_TIMEOUT', None))
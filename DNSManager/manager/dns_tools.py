@@ -0,0 +1,557 @@
+"""
+Synchronization of DNS-entries between zone master and DNSEntryCache.
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from dns.exception import DNSException
+
+import dnsutils
+from dnsutils import DynDNSException
+from .models import DNSEntryCache, DNSUpdate, Domain, ZoneSyncState
+
+
+logger = logging.getLogger('manager.dns_tools')
+
+# Rows created per INSERT statement
+BULK_CREATE_BATCH_SIZE = 1000
+
+# Rows fetched at a time when reading current entries
+CHUNK_SIZE = 2000
+
+# Skip dnssec records for now.
+SKIPPED_RECORD_TYPES = ['RRSIG', 'TYPE65534', 'DNSKEY', 'NSEC']
+
+
+SyncResult = namedtuple('SyncResult', ['added', 'removed', 'unchanged', 'elapsed'])
+
+# Errors raised by synchronize when master cannot be used
+SYNC_ERRORS = dnsutils.NETWORK_ERRORS + (DynDNSException,)
+
+# Domains are checked every SOA refresh seconds, more often if zone changes
+# often, but at most every SYNC_MIN_INTERVAL and at least every
+# SYNC_MAX_INTERVAL seconds. Failed checks are retried after SOA retry
+# seconds, doubling up to SYNC_MAX_RETRY_INTERVAL. Intervals are varied
+# randomly by SYNC_JITTER to spread checks of domains evenly.
+MIN_INTERVAL = getattr(settings, 'SYNC_MIN_INTERVAL', 60)
+MAX_INTERVAL = getattr(settings, 'SYNC_MAX_INTERVAL', 3600)
+MAX_RETRY_INTERVAL = getattr(settings, 'SYNC_MAX_RETRY_INTERVAL', 3600)
+JITTER = getattr(settings, 'SYNC_JITTER', 0.1)
+
+# Weight of latest observed interval in average interval between changes
+CHANGE_WEIGHT = 0.3
+
+# Concurrent background refreshes of domains read by views, 0 disables them
+REFRESH_PARALLEL = getattr(settings, 'DNS_REFRESH_PARALLEL', 2)
+
+# State of DNSEntryCache of a domain, stale if master is unavailable.
+# Age is seconds since entries were last checked from master, None if never,
+# expired if age exceeds max_age of domain.
+CacheState = namedtuple('CacheState', ['stale', 'last_sync', 'last_failure', 'error', 'age', 'expired'])
+
+
+def error_text(e):
+    """
+    :return: message of exception, or its name if message is empty like for dns.exception.Timeout
+    """
+    return (str(e) or e.__class__.__name__)[:8192]
+
+
+def reconcile(domain, records):
+    """
+    Make DNSEntryCache of domain match given records.
+
+    Both sides are keyed by hash of (name, ttl, class, type, data) tuple,
+    so the difference is computed in one pass over each side and only
+    hashes and primary keys are kept in memory. Current rows are read
+    in chunks and records can be a generator, new rows are inserted in
+    batches while records are consumed and removed rows are deleted with
+    one query, all in a single transaction.
+    :param domain: Domain object
+    :param records: iterable of (name, ttl, class, type, data) tuples
+    :return: SyncResult
+    """
+    start = time.time()
+
+    current = {}
+    removed = []
+    rows = DNSEntryCache.objects.filter(domain=domain).values_list(
+        'pk', 'name', 'ttl', 'record_class', 'type', 'data').iterator(chunk_size=CHUNK_SIZE)
+    for row in rows:
+        key = hash(row[1:])
+        if key in current:
+            # Duplicate row, keep only one of them
+            removed.append(row[0])
+        else:
+            current[key] = row[0]
+
+    added = 0
+    seen = set()
+    batch = []
+    with transaction.atomic():
+        for record in records:
+            if record[3] in SKIPPED_RECORD_TYPES:
+                continue
+            key = hash(record)
+            if key in seen:
+                continue
+            seen.add(key)
+            if current.pop(key, None) is None:
+                batch.append(record)
+                if len(batch) >= BULK_CREATE_BATCH_SIZE:
+                    _write_changes(domain, [], batch)
+                    added += len(batch)
+                    batch = []
+
+        # Remove entries not found any more
+        removed.extend(current.values())
+        _write_changes(domain, removed, batch)
+        added += len(batch)
+
+    result = SyncResult(added=added, removed=len(removed),
+                        unchanged=len(seen) - added, elapsed=time.time() - start)
+    logger.info("Synchronized domain %s: %d added, %d removed, %d unchanged in %.3f seconds" % (
+                domain.name, result.added, result.removed, result.unchanged, result.elapsed))
+    return result
+
+
+def apply_changes(domain, deleted, added):
+    """
+    Apply incremental changes to DNSEntryCache of domain.
+    Only rows having same name as some changed record are read.
+    :param domain: Domain object
+    :param deleted: set of (name, ttl, class, type, data) tuples
+    :param added: set of (name, ttl, class, type, data) tuples
+    :return: SyncResult
+    """
+    start = time.time()
+
+    deleted = set(key for key in deleted if key[3] not in SKIPPED_RECORD_TYPES)
+    added = set(key for key in added if key[3] not in SKIPPED_RECORD_TYPES)
+    names = set(key[0] for key in deleted) | set(key[0] for key in added)
+
+    existing = set()
+    removed = []
+    rows = DNSEntryCache.objects.filter(domain=domain, name__in=names).values_list(
+        'pk', 'name', 'ttl', 'record_class', 'type', 'data')
+    for row in rows:
+        key = row[1:]
+        if key in deleted or key in existing:
+            removed.append(row[0])
+        else:
+            existing.add(key)
+
+    added = [key for key in added if key not in existing]
+
+    _write_changes(domain, removed, added)
+
+    result = SyncResult(added=len(added), removed=len(removed),
+                        unchanged=DNSEntryCache.objects.filter(domain=domain).count() - len(added),
+                        elapsed=time.time() - start)
+    logger.info("Incrementally synchronized domain %s: %d added, %d removed in %.3f seconds" % (
+                domain.name, result.added, result.removed, result.elapsed))
+    return result
+
+
+def _cached_soa(domain):
+    """
+    Return SOA serial, refresh and retry of cached entries of domain
+    """
+    soa = DNSEntryCache.objects.filter(domain=domain, name='', type='SOA').values_list('data', flat=True).first()
+    if soa is None:
+        return None, None, None
+    fields = soa.split()
+    return int(fields[2]), int(fields[3]), int(fields[4])
+
+
+def check_interval(state, now):
+    """
+    Seconds until next check of domain.
+    Zone changing more often than its SOA refresh is checked at half of
+    its average interval between changes. Time since last change counts
+    as an interval, so zone which stops changing is checked less often.
+    :param state: ZoneSyncState after synchronization
+    :param now: time of synchronization
+    :return: seconds, with jitter
+    """
+    if state.failures:
+        interval = (state.retry or MIN_INTERVAL) * 2 ** min(state.failures - 1, 16)
+        interval = min(interval, MAX_RETRY_INTERVAL)
+    else:
+        interval = state.refresh or MAX_INTERVAL
+        if state.change_interval is not None:
+            quiet = (now - state.last_change).total_seconds()
+            interval = min(interval, max(state.change_interval, quiet) / 2)
+        interval = min(interval, MAX_INTERVAL)
+    interval = max(interval, MIN_INTERVAL)
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def _observe_change(state, now):
+    """
+    Update average interval between serial changes of zone
+    """
+    if state.last_change is not None:
+        interval = (now - state.last_change).total_seconds()
+        if state.change_interval is None:
+            state.change_interval = interval
+        else:
+            state.change_interval = CHANGE_WEIGHT * interval + (1 - CHANGE_WEIGHT) * state.change_interval
+    state.last_change = now
+
+
+def _write_changes(domain, removed, added):
+    """
+    Delete rows by primary key and insert new records in one transaction
+    """
+    with transaction.atomic():
+        if removed:
+            DNSEntryCache.objects.filter(pk__in=removed).delete()
+        if added:
+            DNSEntryCache.objects.bulk_create(
+                [DNSEntryCache(domain=domain, name=name, ttl=ttl, record_class=rclass, type=rtype, data=rdata)
+                 for (name, ttl, rclass, rtype, rdata) in added],
+                batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def synchronize(domain, force=False):
+    """
+    Synchronize domain dns-entries to database.
+    Zone is transferred only if SOA serial on master differs from the
+    serial of cached entries. Changes since cached serial are requested
+    using IXFR, whole zone is transferred only if master cannot provide
+    differences.
+
+    If master cannot be reached, failure is recorded to ZoneSyncState of
+    domain and exception is raised. Cached entries are left as they are.
+
+    Domain having updates queued in outbox is not synchronized, because
+    cache already has the changes and master does not yet. Its next check
+    is made due at once, so it is synchronized after the updates are sent.
+
+    Only one synchronization of a domain runs at a time. The ZoneSyncState
+    row of domain is locked for the duration of synchronization. If it is
+    already locked, returns immediately and current cache is used, or with
+    force waits for the running synchronization to finish.
+    :param domain: Domain object
+    :param force: transfer whole zone even if serial is unchanged
+    :return: SyncResult or None if cache was up to date, being synchronized or has unsent updates
+    """
+    started = timezone.now()
+    ZoneSyncState.objects.get_or_create(domain=domain)
+    if DNSUpdate.objects.filter(domain=domain).exists():
+        logger.info("Domain %s has unsent updates, synchronizing it later" % domain.name)
+        ZoneSyncState.objects.filter(domain=domain).update(next_check=started)
+        return
+
+    try:
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    state = ZoneSyncState.objects.select_for_update(nowait=not force).get(domain=domain)
+            except DatabaseError:
+                logger.debug("Domain %s is already being synchronized" % domain.name)
+                return
+            if force and state.last_sync is not None and state.last_sync >= started:
+                # Synchronized by someone else while waiting for the lock
+                return
+            return _synchronize(domain, state, force)
+    except SYNC_ERRORS as e:
+        now = timezone.now()
+        state = ZoneSyncState.objects.get(domain=domain)
+        state.failures += 1
+        state.last_failure = now
+        state.last_error = error_text(e)
+        state.next_check = now + timedelta(seconds=check_interval(state, now))
+        state.save(update_fields=['failures', 'last_failure', 'last_error', 'next_check'])
+        raise
+
+
+def cache_state(domain):
+    """
+    :param domain: Domain object
+    :return: CacheState of DNSEntryCache of domain
+    """
+    state = ZoneSyncState.objects.filter(domain=domain).first()
+    if state is None:
+        return CacheState(stale=dnsutils.breakers.is_open(domain.master), last_sync=None, last_failure=None,
+                          error='', age=None, expired=True)
+    age = None
+    if state.last_check is not None:
+        age = max(0, (timezone.now() - state.last_check).total_seconds())
+    return CacheState(stale=state.last_failure is not None or dnsutils.breakers.is_open(domain.master),
+                      last_sync=state.last_sync, last_failure=state.last_failure, error=state.last_error,
+                      age=age, expired=age is None or age > domain.max_age)
+
+
+def revalidate(domain):
+    """
+    Return state of DNSEntryCache of domain without waiting for master.
+    If cached entries are older than max_age of domain, synchronization
+    is started in background and current entries are used meanwhile.
+    After a failed synchronization next one is started after max_age.
+    :param domain: Domain object
+    :return: CacheState
+    """
+    state = cache_state(domain)
+    if not state.expired or dnsutils.breakers.is_open(domain.master):
+        return state
+    if state.last_failure is None or (timezone.now() - state.last_failure).total_seconds() > domain.max_age:
+        refresher.submit(domain)
+    return state
+
+
+def _synchronize(domain, state, force):
+    now = timezone.now()
+
+    if not force and state.last_sync is not None:
+        serial = dnsutils.soa_serial(domain.master, domain.tsig,
+                                     domain.tsig_type, domain.fqdn)
+        if serial == state.serial:
+            state.last_check = now
+            state.last_failure = None
+            state.last_error = ''
+            state.failures = 0
+            state.next_check = now + timedelta(seconds=check_interval(state, now))
+            state.save(update_fields=['last_check', 'last_failure', 'last_error', 'failures', 'next_check'])
+            return
+
+    previous = state.serial
+    diff = None
+    if not force and state.serial is not None:
+        try:
+            diff = dnsutils.ixfr(domain.master, domain.tsig, domain.tsig_type,
+                                 domain.fqdn, state.serial)
+        except dnsutils.UNREACHABLE_ERRORS:
+            # AXFR would wait for the same master again
+            raise
+        except DNSException as e:
+            logger.info("IXFR of domain %s from serial %s failed, using AXFR: %s" % (
+                        domain.name, state.serial, e))
+
+    if diff is None:
+        records = dnsutils.axfr_records(domain.master, domain.tsig,
+                                        domain.tsig_type, domain.fqdn)
+        result = reconcile(domain, records)
+        state.serial = _cached_soa(domain)[0]
+    elif diff.full:
+        result = reconcile(domain, diff.added)
+        state.serial = diff.serial
+    else:
+        result = apply_changes(domain, diff.deleted, diff.added)
+        state.serial = diff.serial
+
+    if previous is not None and state.serial != previous:
+        _observe_change(state, now)
+    state.refresh, state.retry = _cached_soa(domain)[1:]
+    state.last_check = now
+    state.last_sync = now
+    state.last_failure = None
+    state.last_error = ''
+    state.failures = 0
+    state.next_check = now + timedelta(seconds=check_interval(state, now))
+    state.save()
+    return result
+
+
+class SyncWorker(object):
+    """
+    Synchronize domains concurrently on a bounded thread pool.
+    Number of concurrent transfers from same master is limited separately.
+    """
+
+    def __init__(self, parallel=4, per_master=2):
+        self.executor = ThreadPoolExecutor(max_workers=parallel)
+        self.per_master = per_master
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def _master_semaphore(self, master):
+        with self._lock:
+            if master not in self._masters:
+                self._masters[master] = threading.BoundedSemaphore(self.per_master)
+            return self._masters[master]
+
+    def submit(self, domain, force=False):
+        """
+        Schedule synchronization of domain
+        :param domain: Domain object
+        :param force: transfer whole zone even if serial is unchanged
+        :return: Future resolving to SyncResult or None
+        """
+        return self.executor.submit(self._synchronize, domain, force)
+
+    def _synchronize(self, domain, force):
+        start = time.time()
+        try:
+            with self._master_semaphore(domain.master):
+                result = synchronize(domain, force)
+            logger.info("Domain %s checked in %.3f seconds: %s" % (
+                        domain.name, time.time() - start, result or 'up to date'))
+            return result
+        except Exception:
+            logger.exception("Failed to synchronize domain %s in %.3f seconds" % (
+                             domain.name, time.time() - start))
+        finally:
+            close_old_connections()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class SyncScheduler(object):
+    """
+    Synchronize domains when their next check is due, earliest first.
+
+    Due times come from ZoneSyncState.next_check, so checks triggered
+    elsewhere, like by NOTIFY, move them as well. Domains are kept in a
+    priority queue, which is reloaded from database every reload_interval
+    seconds to see new and changed domains. Only as many domains as the
+    worker runs in parallel are submitted at a time, the rest wait in the
+    queue in order.
+    """
+
+    def __init__(self, worker, parallel=4, max_interval=None, reload_interval=60):
+        """
+        :param worker: SyncWorker
+        :param parallel: number of domains submitted to worker at a time
+        :param max_interval: seconds, check every domain at least this often
+        :param reload_interval: seconds between reloading domains from database
+        """
+        self.worker = worker
+        self.parallel = parallel
+        self.max_interval = max_interval or MAX_INTERVAL
+        self.reload_interval = reload_interval
+        self._queue = []  # heap of (due timestamp, domain pk)
+        self._domains = {}
+        self._running = {}
+        self._loaded = 0
+
+    def reload(self):
+        """
+        Rebuild queue from domains and their ZoneSyncState
+        """
+        now = time.time()
+        self._domains = {}
+        self._queue = []
+        for domain in Domain.objects.select_related('sync_state'):
+            self._domains[domain.pk] = domain
+            if domain.pk not in self._running:
+                self._queue.append((self._due(domain, now), domain.pk))
+        heapq.heapify(self._queue)
+        self._loaded = now
+
+    def _due(self, domain, now):
+        try:
+            state = domain.sync_state
+        except ZoneSyncState.DoesNotExist:
+            return now
+        if state.next_check is None:
+            return now
+        due = state.next_check.timestamp()
+        if not state.failures and state.last_check is not None:
+            due = min(due, state.last_check.timestamp() + self.max_interval)
+        return due
+
+    def run_pending(self):
+        """
+        Submit due domains to worker and requeue finished ones
+        :return: seconds until next domain is due
+        """
+        now = time.time()
+        if now - self._loaded >= self.reload_interval:
+            self.reload()
+        for pk, future in list(self._running.items()):
+            if future.done():
+                del self._running[pk]
+                self._requeue(pk, now)
+        while self._queue and self._queue[0][0] <= now and len(self._running) < self.parallel:
+            _, pk = heapq.heappop(self._queue)
+            if pk in self._domains and pk not in self._running:
+                self._running[pk] = self.worker.submit(self._domains[pk])
+        if len(self._running) >= self.parallel or not self._queue:
+            return 1
+        return max(0, min(self._queue[0][0] - now, 1))
+
+    def _requeue(self, pk, now):
+        domain = Domain.objects.select_related('sync_state').filter(pk=pk).first()
+        if domain is None:
+            self._domains.pop(pk, None)
+            return
+        self._domains[pk] = domain
+        # Domain may not have been checked, for example if it was locked by someone else
+        heapq.heappush(self._queue, (max(self._due(domain, now), now + MIN_INTERVAL * JITTER), pk))
+
+    def run(self):
+        """
+        Run forever
+        """
+        while True:
+            time.sleep(self.run_pending())
+
+    def stats(self):
+        return {'queued': len(self._queue), 'running': len(self._running), 'domains': len(self._domains)}
+
+
+class BackgroundRefresh(object):
+    """
+    Synchronize domains in background, for example ones read by views.
+    Domain already waiting or being synchronized is not submitted again,
+    with again it is synchronized once more after current one finishes.
+    """
+
+    def __init__(self, parallel=2, per_master=1):
+        self.parallel = parallel
+        self.per_master = per_master
+        self._worker = None
+        self._pending = {}
+        self._again = set()
+        self._lock = threading.Lock()
+
+    def submit(self, domain, again=False):
+        """
+        :param domain: Domain object
+        :param again: synchronize again if domain is already being synchronized
+        :return: True if synchronization was scheduled
+        """
+        if self.parallel <= 0:
+            return False
+        with self._lock:
+            if domain.pk in self._pending:
+                if again:
+                    self._again.add(domain.pk)
+                return False
+            if self._worker is None:
+                self._worker = SyncWorker(parallel=self.parallel, per_master=self.per_master)
+            self._pending[domain.pk] = domain
+        future = self._worker.submit(domain)
+        future.add_done_callback(lambda future: self._done(domain.pk))
+        return True
+
+    def _done(self, pk):
+        with self._lock:
+            domain = self._pending.pop(pk)
+            if pk not in self._again:
+                return
+            self._again.discard(pk)
+        self.submit(domain)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'again': len(self._again)}
+
+    def shutdown(self, wait=True):
+        if self._worker is not None:
+            self._worker.shutdown(wait=wait)
+
+
+refresher = BackgroundRefresh(parallel=REFRESH_PARALLEL)
@@ -0,0 +1,155 @@
+"""
+Coalescing of dyndns updates.
+
+Clients often report their address many times in a short time. Reported
+addresses are stored with record() and only the latest address of each
+client is queued to the outbox by flush() once the coalescing window has
+passed. Pending addresses of all clients of a zone go out in one UPDATE.
+Address equal to the last one sent for the client is not queued at all.
+
+Each address is sent as a single replace of the RRset, so no lookup of
+current records is needed. With DYNDNS_PREREQUISITE the replace is sent
+in its own UPDATE requiring the previous address to be still present.
+"""
+
+import ipaddress
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from dns.exception import DNSException
+
+from dnsutils import DynDNSException
+
+from . import outbox, stats
+from .models import Client, DNSEntryCache, PendingAddress
+
+
+logger = logging.getLogger('manager.dyndns')
+
+COALESCE_WINDOW = getattr(settings, 'DYNDNS_COALESCE_WINDOW', 10)
+PREREQUISITE = getattr(settings, 'DYNDNS_PREREQUISITE', False)
+
+# TTL of dyndns records
+DYNDNS_TTL = 60
+
+# Client field holding last address of record type
+LAST_ADDRESS_FIELDS = {
+    'A': 'last_ipv4',
+    'AAAA': 'last_ipv6',
+}
+
+
+def address_type(address):
+    """
+    :return: record type of address, A or AAAA
+    :raises ValueError: if address is not an IP address
+    """
+    if ipaddress.ip_address(address).version == 6:
+        return 'AAAA'
+    return 'A'
+
+
+def parse_addresses(*values):
+    """
+    Parse comma separated address lists, later address of same type wins
+    :param values: strings of comma separated IPv4 and IPv6 addresses
+    :return: dict of record type to normalized address
+    :raises ValueError: if some address is not an IP address
+    """
+    addresses = OrderedDict()
+    for value in values:
+        for address in (value or '').split(','):
+            address = address.strip()
+            if address:
+                address = str(ipaddress.ip_address(address))
+                addresses[address_type(address)] = address
+    return addresses
+
+
+def is_current(client, type, address):
+    """
+    Check if address is already the address of client.
+    Uses last address sent for client, or cached entries if it is not known.
+    """
+    last = getattr(client, LAST_ADDRESS_FIELDS[type])
+    if last is not None:
+        return last == address
+    return DNSEntryCache.objects.filter(domain_id=client.domain_id, name=client.name,
+                                        type=type, data=address).exists()
+
+
+def record(client, type, address):
+    """
+    Store latest address of client, replacing address pending from earlier update
+    :param client: Client object
+    :param type: A or AAAA
+    :param address: address string
+    :return: True if address was queued, False if it did not change
+    """
+    if is_current(client, type, address):
+        stats.increment('dyndns_nochg')
+        return False
+    field = LAST_ADDRESS_FIELDS[type]
+    with transaction.atomic():
+        pending = PendingAddress.objects.filter(client=client, type=type)
+        if not pending.update(address=address, updated=timezone.now()):
+            try:
+                with transaction.atomic():
+                    PendingAddress.objects.create(client=client, type=type, address=address,
+                                                  previous=getattr(client, field))
+            except IntegrityError:
+                # Created by concurrent update of same client
+                pending.update(address=address, updated=timezone.now())
+        Client.objects.filter(pk=client.pk).update(**{field: address})
+    setattr(client, field, address)
+    stats.increment('dyndns_queued')
+    return True
+
+
+def flush(window=None):
+    """
+    Queue pending addresses reported at least window seconds ago to outbox,
+    one UPDATE per domain, or one per address with DYNDNS_PREREQUISITE
+    :param window: seconds, defaults to DYNDNS_COALESCE_WINDOW setting
+    :return: number of addresses queued
+    """
+    if window is None:
+        window = COALESCE_WINDOW
+    deadline = timezone.now() - timedelta(seconds=window)
+    queued = 0
+    with transaction.atomic():
+        pending = PendingAddress.objects.select_for_update(skip_locked=True, of=('self',)).select_related(
+            'client__domain').filter(created__lte=deadline).order_by('id')
+        domains = OrderedDict()
+        for address in pending:
+            domains.setdefault(address.client.domain_id, []).append(address)
+
+        for addresses in domains.values():
+            domain = addresses[0].client.domain
+            try:
+                changes = domain.changeset()
+            except DynDNSException as e:
+                logger.error("Cannot queue addresses of domain %s: %s" % (domain.name, e))
+                continue
+            for address in addresses:
+                try:
+                    if PREREQUISITE and address.previous:
+                        checked = domain.changeset()
+                        checked.present(address.client.fqdn, address.type, address.previous)
+                        checked.replace(address.client.fqdn, DYNDNS_TTL, address.type, address.address)
+                        outbox.enqueue(domain, checked)
+                        queued += 1
+                    else:
+                        changes.replace(address.client.fqdn, DYNDNS_TTL, address.type, address.address)
+                except DNSException as e:
+                    logger.error("Ignoring invalid address %s of %s: %s" % (address.address, address.client.fqdn, e))
+            outbox.enqueue(domain, changes)
+            queued += len(changes)
+            PendingAddress.objects.filter(pk__in=[address.pk for address in addresses]).delete()
+    if queued:
+        logger.info("Queued %d dyndns addresses of %d domains" % (queued, len(domains)))
+    return queued
@@ -0,0 +1,27 @@
+"""
+Settings for the dyndns update endpoints served by manager/dyndns_wsgi.py.
+
+Only what the update protocol needs is loaded: no admin, sessions, CSRF,
+authentication, messages, templates or REST framework. Database, cache
+and dyndns settings are the same as in manager/settings.py, including
+local_settings overrides.
+"""
+
+from manager.settings import *
+
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'manager',
+)
+
+MIDDLEWARE = (
+    'XForwardedForMiddleware.XForwardedForMiddleware',
+)
+
+ROOT_URLCONF = 'manager.dyndns_urls'
+
+WSGI_APPLICATION = 'manager.dyndns_wsgi.application'
+
+TEMPLATES = []
@@ -0,0 +1,9 @@
+from django.urls import re_path
+
+import manager.views
+
+
+urlpatterns = [
+    re_path(r'^api/update/(?P<secret>[a-zA-Z0-9]+)$', manager.views.update, name="api_update"),
+    re_path(r'^nic/update$', manager.views.nic_update, name="nic_update"),
+]
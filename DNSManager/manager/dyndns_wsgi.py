@@ -0,0 +1,15 @@
+"""
+WSGI config for the dyndns update endpoint only.
+
+Serves /api/update/<secret> and dyndns2 /nic/update with trimmed settings from
+manager/dyndns_settings.py, so it can be deployed and scaled separately
+from the web interface, for example
+
+    gunicorn --workers 4 manager.dyndns_wsgi:application
+"""
+
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "manager.dyndns_settings")
+
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
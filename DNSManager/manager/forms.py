@@ -5,15 +5,21 @@ from dnsutils import validate_data
 class DomainForm(ModelForm):
     class Meta:
          model = Domain
-         fields = ['name', 'comment', 'tsig_key', 'tsig_type', 'master']
+         fields = ['name', 'comment', 'tsig_key', 'tsig_type', 'master', 'max_age']
 
+    def clean_max_age(self):
+        max_age = self.cleaned_data['max_age']
+        if max_age is None:
+            return Domain._meta.get_field('max_age').default
+        return max_age
 
-class DomainEditForm(ModelForm):
+
+class DomainEditForm(DomainForm):
     readonly_fields = ('name',)
 
     class Meta:
          model = Domain
-         fields = ['name', 'comment', 'tsig_key', 'tsig_type', 'master']
+         fields = ['name', 'comment', 'tsig_key', 'tsig_type', 'master', 'max_age']
 
 
 class ClientForm(ModelForm):
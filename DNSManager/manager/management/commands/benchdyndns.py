@@ -0,0 +1,84 @@
+"""
+Compare request rate of the dyndns update endpoint served by the full
+web application and by manager/dyndns_wsgi.py.
+"""
+
+import io
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from manager import dyndns_settings, ratelimit
+from manager.models import Client
+from utils import hash_password
+
+
+class Command(BaseCommand):
+    help = "Benchmark /api/update/<secret> through full middleware stack and dyndns-only application. " \
+           "Requests are handled in-process, so only Django overhead is measured."
+
+    def add_arguments(self, parser):
+        parser.add_argument('secret', help="Secret of an existing dyndns client")
+        parser.add_argument('--requests', type=int, default=2000, help="Number of requests per application")
+        parser.add_argument('--host', default='localhost', help="Host header, must be in ALLOWED_HOSTS")
+
+    def handle(self, *args, **options):
+        try:
+            client = Client.objects.get(secret=hash_password(options['secret']))
+        except Client.DoesNotExist:
+            raise CommandError("No client with given secret")
+        # Report current address, so requests are answered without changes
+        address = client.last_ipv4 or '192.0.2.1'
+        path = '/api/update/%s' % options['secret']
+        # Measure request handling, not rejections
+        ratelimit.BURST = 0
+
+        full = WSGIHandler()
+        with override_settings(MIDDLEWARE=dyndns_settings.MIDDLEWARE, ROOT_URLCONF=dyndns_settings.ROOT_URLCONF):
+            light = WSGIHandler()
+
+        results = []
+        for name, application, overrides in (
+                ('full', full, {}),
+                ('dyndns', light, {'MIDDLEWARE': dyndns_settings.MIDDLEWARE,
+                                   'ROOT_URLCONF': dyndns_settings.ROOT_URLCONF})):
+            with override_settings(**overrides):
+                # Warm up caches
+                self.request(application, path, options['host'], address)
+                start = time.time()
+                for _ in range(options['requests']):
+                    status = self.request(application, path, options['host'], address)
+                elapsed = time.time() - start
+            rate = options['requests'] / elapsed
+            results.append(rate)
+            self.stdout.write("%-7s %s, %d requests in %.3f seconds, %.0f requests/s" % (
+                              name, status, options['requests'], elapsed, rate))
+        self.stdout.write("dyndns application is %.1fx faster" % (results[1] / results[0]))
+
+    def request(self, application, path, host, address):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': host,
+            'REMOTE_ADDR': address,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multiprocess': False,
+            'wsgi.multithread': False,
+            'wsgi.run_once': False,
+        }
+        status = []
+        response = application(environ, lambda s, headers, exc_info=None: status.append(s))
+        b''.join(response)
+        if hasattr(response, 'close'):
+            response.close()
+        return status[0]
@@ -0,0 +1,39 @@
+"""
+Synchronize domains when their zone masters send DNS NOTIFY.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from manager.notify import NotifyListener
+
+
+logger = logging.getLogger('manager.notifyd')
+
+
+class Command(BaseCommand):
+    help = "Listen for DNS NOTIFY from zone masters and synchronize notified domains. " \
+           "Add listen address to also-notify of zones on masters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default='0.0.0.0', help="Address to listen on")
+        parser.add_argument('--port', type=int, default=53, help="UDP and TCP port to listen on")
+        parser.add_argument('--parallel', type=int, default=4, help="Number of concurrent synchronizations")
+        parser.add_argument('--per-master', type=int, default=2,
+                            help="Number of concurrent synchronizations from same master server")
+        parser.add_argument('--stats-interval', type=int, default=3600,
+                            help="Seconds between logging statistics")
+
+    def handle(self, *args, **options):
+        listener = NotifyListener(options['address'], options['port'],
+                                  parallel=options['parallel'], per_master=options['per_master'])
+        listener.start()
+        logger.info("Listening for NOTIFY on %s port %d" % (options['address'], options['port']))
+        try:
+            while True:
+                time.sleep(options['stats_interval'])
+                logger.info("NOTIFY statistics: %s" % listener.notify.stats())
+        finally:
+            listener.shutdown()
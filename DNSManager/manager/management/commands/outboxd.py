@@ -0,0 +1,38 @@
+"""
+Send queued DNS updates and coalesced dyndns addresses to zone masters.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from manager import dyndns
+from manager.outbox import OutboxWorker
+
+
+logger = logging.getLogger('manager.outboxd')
+
+
+class Command(BaseCommand):
+    help = "Send queued DNS updates to zone masters. Runs forever unless --once is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Send updates which are due once and exit")
+        parser.add_argument('--parallel', type=int, default=4, help="Number of domains sent concurrently")
+        parser.add_argument('--interval', type=float, default=1, help="Seconds between checks for new updates")
+
+    def handle(self, *args, **options):
+        worker = OutboxWorker(parallel=options['parallel'])
+        try:
+            if options['once']:
+                dyndns.flush(window=0)
+                worker.drain()
+                return
+            while True:
+                start = time.time()
+                dyndns.flush()
+                worker.drain()
+                time.sleep(max(0, options['interval'] - (time.time() - start)))
+        finally:
+            worker.shutdown()
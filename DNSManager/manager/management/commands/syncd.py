@@ -0,0 +1,52 @@
+"""
+Keep DNSEntryCache of domains synchronized with zone masters.
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from manager.dns_tools import SyncScheduler, SyncWorker
+from manager.models import Domain
+
+
+logger = logging.getLogger('manager.syncd')
+
+
+class Command(BaseCommand):
+    help = "Synchronize DNS-entries of domains from zone masters. " \
+           "Runs forever unless --all or domain names are given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('domains', nargs='*', help="Synchronize only these domains once and exit")
+        parser.add_argument('--all', action='store_true', help="Synchronize all domains once and exit")
+        parser.add_argument('--parallel', type=int, default=4, help="Number of concurrent synchronizations")
+        parser.add_argument('--per-master', type=int, default=2,
+                            help="Number of concurrent synchronizations from same master server")
+        parser.add_argument('--interval', type=int, default=None,
+                            help="Maximum seconds between checks of a domain, defaults to SYNC_MAX_INTERVAL setting. "
+                                 "Domains are checked by their SOA refresh and retry times and how often they change")
+        parser.add_argument('--force', action='store_true', help="Transfer whole zones even if serial is unchanged, "
+                                                                      "with --all or domain names")
+
+    def handle(self, *args, **options):
+        worker = SyncWorker(parallel=options['parallel'], per_master=options['per_master'])
+        try:
+            if options['all'] or options['domains']:
+                self.synchronize_round(worker, options['domains'], options['force'])
+                return
+            scheduler = SyncScheduler(worker, parallel=options['parallel'], max_interval=options['interval'])
+            scheduler.run()
+        finally:
+            worker.shutdown()
+
+    def synchronize_round(self, worker, names, force):
+        start = time.time()
+        domains = Domain.objects.all()
+        if names:
+            domains = domains.filter(name__in=names)
+        futures = [worker.submit(domain, force) for domain in domains]
+        for future in futures:
+            future.result()
+        logger.info("Synchronized %d domains in %.3f seconds" % (len(futures), time.time() - start))
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0003_auto_20151210_1948'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZoneSyncState',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('serial', models.BigIntegerField(null=True, blank=True)),
+                ('last_check', models.DateTimeField(null=True, blank=True)),
+                ('last_sync', models.DateTimeField(null=True, blank=True)),
+                ('domain', models.OneToOneField(to='manager.Domain', on_delete=models.CASCADE, related_name='sync_state')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0004_zonesyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DNSUpdate',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('operations', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+                ('last_error', models.CharField(max_length=8192, blank=True, default='')),
+                ('domain', models.ForeignKey(to='manager.Domain', on_delete=models.CASCADE, related_name='updates')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+            bases=(models.Model,),
+        ),
+    ]
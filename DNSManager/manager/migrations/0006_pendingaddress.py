@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0005_dnsupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAddress',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('type', models.CharField(max_length=128)),
+                ('address', models.CharField(max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('client', models.ForeignKey(to='manager.Client', on_delete=models.CASCADE, related_name='pending_addresses')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pendingaddress',
+            unique_together=set([('client', 'type')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0006_pendingaddress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='last_ipv4',
+            field=models.GenericIPAddressField(protocol='IPv4', null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='last_ipv6',
+            field=models.GenericIPAddressField(protocol='IPv6', null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0007_client_last_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingaddress',
+            name='previous',
+            field=models.CharField(max_length=128, null=True, blank=True),
+        ),
+    ]
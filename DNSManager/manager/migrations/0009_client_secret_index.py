@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0008_pendingaddress_previous'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='client',
+            name='secret',
+            field=models.CharField(max_length=1024, db_index=True),
+        ),
+    ]
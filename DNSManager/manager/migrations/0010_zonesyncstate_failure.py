@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0009_client_secret_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='last_failure',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='last_error',
+            field=models.CharField(max_length=8192, blank=True, default=''),
+        ),
+    ]
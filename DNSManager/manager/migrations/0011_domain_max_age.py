@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0010_zonesyncstate_failure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domain',
+            name='max_age',
+            field=models.PositiveIntegerField(default=300, help_text='Seconds cached records are used before refreshing them from master'),
+        ),
+    ]
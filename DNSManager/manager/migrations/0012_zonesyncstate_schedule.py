@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0011_domain_max_age'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='refresh',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='retry',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='last_change',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='change_interval',
+            field=models.FloatField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='zonesyncstate',
+            name='next_check',
+            field=models.DateTimeField(null=True, blank=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0012_zonesyncstate_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='domain',
+            name='max_age',
+            field=models.PositiveIntegerField(default=300, blank=True, help_text='Seconds cached records are used before refreshing them from master'),
+        ),
+    ]
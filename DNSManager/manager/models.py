@@ -1,11 +1,13 @@
-import socket
 from datetime import datetime
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth.models import User, Group
-from dnsutils import checkKey, DynDNSException
+from dnsutils import addresses, checkKey, keyrings, parseKey, zones, ChangeSet, DynDNSException
 
 from hashlib import sha512
 import string
@@ -36,10 +38,8 @@ def tsig_key_validator(value):
 
 
 def check_master(value):
-    try:
-        socket.gethostbyname(value)
-    except socket.gaierror:
-        raise ValueError("%s is not valid dns-server" % value)
+    if not addresses.get(value):
+        raise ValidationError("%s is not valid dns-server" % value)
 
 
 def get_user_domain_filter(user):
@@ -61,6 +61,7 @@ class Domain(models.Model):
     tsig_key = models.CharField(max_length=8192, null=False, validators=[tsig_key_validator])
     tsig_type = models.CharField(max_length=8192, null=False, default="HMAC_MD5", choices=TSIG_KEY_TYPES)
     master = models.CharField(max_length=8192, null=False, help_text="DNS zone master server address", validators=[check_master])
+    max_age = models.PositiveIntegerField(default=300, blank=True, help_text="Seconds cached records are used before refreshing them from master")
 
     @classmethod
     def user_objects(cls, user):
@@ -70,18 +71,50 @@ class Domain(models.Model):
     def fqdn(self):
         return '%s.' % self.name.rstrip('.')
 
+    @property
+    def tsig(self):
+        """
+        Parsed TSIG key, cached until domain is saved again
+        """
+        if self.pk is None:
+            return parseKey(self.tsig_key, self.tsig_type)
+        return keyrings.get(self.tsig_key, self.tsig_type, owner=self.pk)
+
+    def changeset(self):
+        """
+        :return: dnsutils.ChangeSet for sending changes to zone master
+        """
+        return ChangeSet(self.master, self.tsig, self.tsig_type, self.fqdn)
+
     def __str__(self):
         return 'Domain %s' % self.name
 
 
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+def invalidate_domain_keyring(sender, instance, **kwargs):
+    keyrings.invalidate(instance.pk)
+    zones.invalidate()
+
+
+def domain_zones():
+    return [domain.fqdn for domain in Domain.objects.only('name')]
+
+
+# Reverse zones of PTR records are looked up from domains first
+zones.loader = domain_zones
+
+
 class Client(models.Model):
     """
     Client updates certain DNS record
     """
     domain = models.ForeignKey(Domain, on_delete=models.CASCADE)
-    secret = models.CharField(max_length=1024, null=False)  # SHA512 hashed secret
+    secret = models.CharField(max_length=1024, null=False, db_index=True)  # SHA512 hashed secret
     name = models.CharField(max_length=128, null=False)
     comment = models.CharField(max_length=8192, null=False, default="")
+    last_ipv4 = models.GenericIPAddressField(protocol='IPv4', null=True, blank=True)  # Last address sent to master
+    last_ipv6 = models.GenericIPAddressField(protocol='IPv6', null=True, blank=True)
 
     class Meta:
         unique_together = ('domain', 'name',)
@@ -142,3 +175,64 @@ class DNSEntryCache(models.Model):
 
     def __str__(self):
         return 'DNSEntryCache %s.%s %s %s' % (self.name, self.domain.name, self.type, self.data[:128])
+
+
+class ZoneSyncState(models.Model):
+    """
+    Synchronization state of DNSEntryCache of a Domain
+    """
+    domain = models.OneToOneField(Domain, on_delete=models.CASCADE, related_name='sync_state')
+    serial = models.BigIntegerField(null=True, blank=True)  # SOA serial of cached entries
+    last_check = models.DateTimeField(null=True, blank=True)  # Last time serial was checked from master
+    last_sync = models.DateTimeField(null=True, blank=True)  # Last time entries were transferred
+    last_failure = models.DateTimeField(null=True, blank=True)  # Set if last synchronization failed
+    last_error = models.CharField(max_length=8192, null=False, blank=True, default="")
+    failures = models.PositiveIntegerField(default=0)  # Consecutive failed synchronizations
+    refresh = models.PositiveIntegerField(null=True, blank=True)  # SOA refresh of cached zone
+    retry = models.PositiveIntegerField(null=True, blank=True)  # SOA retry of cached zone
+    last_change = models.DateTimeField(null=True, blank=True)  # Last time serial was seen changed
+    change_interval = models.FloatField(null=True, blank=True)  # Average seconds between serial changes
+    next_check = models.DateTimeField(null=True, blank=True, db_index=True)  # When syncd checks domain next
+
+    def __str__(self):
+        return 'ZoneSyncState %s serial %s' % (self.domain.name, self.serial)
+
+
+class DNSUpdate(models.Model):
+    """
+    Outbox of changes waiting to be sent to zone master.
+    Created in the same transaction as the DNSEntryCache change, sent in id order per domain.
+    """
+
+    class Meta:
+        ordering = ['id']
+
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE, related_name='updates')
+    operations = models.TextField(null=False)  # JSON list of dnsutils.ChangeSet operations
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(null=False, default=0)
+    next_attempt = models.DateTimeField(null=False, default=timezone.now, db_index=True)
+    last_error = models.CharField(max_length=8192, null=False, blank=True, default="")
+
+    def __str__(self):
+        return 'DNSUpdate %s #%s' % (self.domain.name, self.pk)
+
+
+class PendingAddress(models.Model):
+    """
+    Latest address reported by a dyndns client, waiting to be queued to zone master.
+    Updates within the coalescing window overwrite the address, see manager/dyndns.py.
+    """
+
+    class Meta:
+        unique_together = ('client', 'type',)
+
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='pending_addresses')
+    type = models.CharField(max_length=128, null=False)  # A or AAAA
+    address = models.CharField(max_length=128, null=False)
+    previous = models.CharField(max_length=128, null=True, blank=True)  # Address on master before this window
+    created = models.DateTimeField(auto_now_add=True, db_index=True)  # First update within window
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return 'PendingAddress %s %s %s' % (self.client.fqdn, self.type, self.address)
@@ -0,0 +1,229 @@
+"""
+Listener for DNS NOTIFY messages from zone masters.
+
+Masters send NOTIFY to their also-notify targets when a zone changes.
+Zone of the message is matched against Domain names and the sender
+must be an address of master of the domain. Signed messages must be
+signed with TSIG key of the domain. Accepted notifications synchronize
+just that domain in background, unless the SOA serial in the message
+is already cached.
+"""
+
+import ipaddress
+import logging
+import socket
+import socketserver
+import struct
+import threading
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.opcode
+import dns.rcode
+import dns.rdatatype
+from django.db import close_old_connections
+
+from dnsutils import DynDNSException, addresses
+from .dns_tools import BackgroundRefresh
+from .models import Domain, ZoneSyncState
+
+
+logger = logging.getLogger('manager.notify')
+
+# Seconds to wait for a TCP client
+TCP_TIMEOUT = 10
+
+
+def _normalize(address):
+    """
+    :return: address as ipaddress object, IPv4-mapped IPv6 addresses as IPv4
+    """
+    address = ipaddress.ip_address(address.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+def is_master(domain, sender):
+    """
+    Check if sender address is an address of master of domain
+    :param domain: Domain object
+    :param sender: IP address string
+    """
+    sender = _normalize(sender)
+    return any(_normalize(address) == sender for address in addresses.get(domain.master))
+
+
+def find_domain(name):
+    """
+    :param name: dns.name.Name of zone
+    :return: Domain object or None
+    """
+    name = name.to_text().rstrip('.')
+    return Domain.objects.filter(name__in=[name, name + '.']).first()
+
+
+def _notified_serial(message):
+    for rrset in message.answer:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return rrset[0].serial
+    return None
+
+
+def _response(query, rcode):
+    response = dns.message.make_response(query)
+    if query.had_tsig:
+        # make_response of dnspython 1.12 sets other_data as str, which cannot be signed on Python 3
+        response.use_tsig(query.keyring, query.keyname, algorithm=query.keyalgorithm)
+    response.flags |= dns.flags.AA
+    response.set_rcode(rcode)
+    return response
+
+
+class NotifyHandler(object):
+    """
+    Answer NOTIFY messages and schedule synchronization of notified domains
+    """
+
+    def __init__(self, refresh):
+        """
+        :param refresh: dns_tools.BackgroundRefresh used to synchronize domains
+        """
+        self.refresh = refresh
+        self.received = 0
+        self.accepted = 0
+        self.refused = 0
+
+    def handle(self, wire, sender):
+        """
+        :param wire: message in wire format
+        :param sender: IP address string of sender
+        :return: response in wire format or None if message is ignored
+        """
+        try:
+            query = dns.message.from_wire(wire, question_only=True)
+        except dns.exception.DNSException as e:
+            logger.debug("Ignoring invalid message from %s: %s" % (sender, e))
+            return None
+        if query.flags & dns.flags.QR:
+            return None
+        self.received += 1
+        if query.opcode() != dns.opcode.NOTIFY:
+            return _response(query, dns.rcode.NOTIMP).to_wire()
+        if len(query.question) != 1 or query.question[0].rdtype != dns.rdatatype.SOA:
+            return _response(query, dns.rcode.FORMERR).to_wire()
+
+        zone = query.question[0].name
+        domain = find_domain(zone)
+        if domain is None:
+            self.refused += 1
+            logger.warning("NOTIFY from %s for unknown zone %s" % (sender, zone))
+            return _response(query, dns.rcode.NOTAUTH).to_wire()
+        if not is_master(domain, sender):
+            self.refused += 1
+            logger.warning("NOTIFY for zone %s from %s which is not master %s" % (zone, sender, domain.master))
+            return _response(query, dns.rcode.REFUSED).to_wire()
+
+        try:
+            # Signature is verified if message is signed
+            query = dns.message.from_wire(wire, keyring=domain.tsig.keyring)
+        except (dns.exception.DNSException, DynDNSException) as e:
+            self.refused += 1
+            logger.warning("NOTIFY for zone %s from %s rejected: %s" % (zone, sender, e.__class__.__name__))
+            return _response(query, dns.rcode.REFUSED).to_wire()
+
+        self.accepted += 1
+        serial = _notified_serial(query)
+        if serial is not None and ZoneSyncState.objects.filter(domain=domain, serial=serial).exists():
+            logger.info("NOTIFY for zone %s serial %s from %s, already cached" % (zone, serial, sender))
+        else:
+            logger.info("NOTIFY for zone %s serial %s from %s, synchronizing" % (zone, serial, sender))
+            self.refresh.submit(domain, again=True)
+        return _response(query, dns.rcode.NOERROR).to_wire()
+
+    def stats(self):
+        return {'received': self.received, 'accepted': self.accepted, 'refused': self.refused,
+                'refresh': self.refresh.stats()}
+
+
+class _UDPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        wire, sock = self.request
+        try:
+            response = self.server.notify.handle(wire, self.client_address[0])
+        finally:
+            close_old_connections()
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.settimeout(TCP_TIMEOUT)
+        try:
+            while True:
+                header = self._read(2)
+                if header is None:
+                    return
+                wire = self._read(struct.unpack('!H', header)[0])
+                if wire is None:
+                    return
+                try:
+                    response = self.server.notify.handle(wire, self.client_address[0])
+                finally:
+                    close_old_connections()
+                if response is not None:
+                    self.request.sendall(struct.pack('!H', len(response)) + response)
+        except socket.error as e:
+            logger.debug("TCP connection from %s failed: %s" % (self.client_address[0], e))
+
+    def _read(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class _ServerMixin(object):
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, notify):
+        if ipaddress.ip_address(server_address[0]).version == 6:
+            self.address_family = socket.AF_INET6
+        self.notify = notify
+        super(_ServerMixin, self).__init__(server_address, handler_class)
+
+
+class _UDPServer(_ServerMixin, socketserver.UDPServer):
+    pass
+
+
+class _TCPServer(_ServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+
+class NotifyListener(object):
+    """
+    Receive NOTIFY messages over UDP and TCP on given address and port
+    """
+
+    def __init__(self, address='0.0.0.0', port=53, parallel=4, per_master=2):
+        self.notify = NotifyHandler(BackgroundRefresh(parallel=parallel, per_master=per_master))
+        self.servers = [_UDPServer((address, port), _UDPHandler, self.notify),
+                        _TCPServer((address, port), _TCPHandler, self.notify)]
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.notify.refresh.shutdown()
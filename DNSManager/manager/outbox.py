@@ -0,0 +1,141 @@
+"""
+Transactional outbox of DNS updates.
+
+Views save DNSEntryCache changes and queue the matching DNS update with
+enqueue() in the same database transaction. OutboxWorker sends queued
+updates to zone masters in creation order per domain and retries failed
+ones with exponential backoff, so requests do not wait for masters.
+"""
+
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from dnsutils import PrerequisiteFailed
+from .dns_tools import error_text, synchronize
+from .models import Client, Domain, DNSUpdate, ZoneSyncState
+
+
+logger = logging.getLogger('manager.outbox')
+
+MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 10)
+RETRY_DELAY = getattr(settings, 'OUTBOX_RETRY_DELAY', 5)
+MAX_RETRY_DELAY = getattr(settings, 'OUTBOX_MAX_RETRY_DELAY', 600)
+
+
+def enqueue(domain, changeset):
+    """
+    Queue changes to be sent to master of domain.
+    Call inside the transaction which changes DNSEntryCache.
+    :param domain: Domain object
+    :param changeset: dnsutils.ChangeSet
+    :return: DNSUpdate or None if changeset is empty
+    """
+    operations = changeset.operations()
+    if not operations:
+        return None
+    return DNSUpdate.objects.create(domain=domain, operations=json.dumps(operations))
+
+
+def retry_delay(attempts):
+    """
+    :return: seconds to wait before next attempt after given number of failed attempts
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def send_pending(domain):
+    """
+    Send queued updates of domain in order.
+    Stops at first failure, later updates wait until it succeeds or is
+    dropped after MAX_ATTEMPTS. Update whose prerequisites fail is dropped
+    without retrying. Dropping an update makes DNSEntryCache
+    and last addresses of clients differ from master, so last addresses
+    are forgotten and whole zone is transferred again once no updates of
+    the domain are queued.
+
+    Domain row is locked while an update is sent. If another worker holds
+    the lock, returns immediately.
+    :param domain: Domain object
+    :return: number of updates sent
+    """
+    sent = 0
+    while True:
+        failed = dropped = False
+        with transaction.atomic():
+            locked = Domain.objects.select_for_update(skip_locked=True).filter(pk=domain.pk).first()
+            if locked is None:
+                return sent
+            update = DNSUpdate.objects.filter(domain=locked).order_by('id').first()
+            if update is None or update.next_attempt > timezone.now():
+                return sent
+            try:
+                changeset = locked.changeset()
+                changeset.load(json.loads(update.operations))
+                changeset.send()
+            except Exception as e:
+                failed = True
+                update.attempts += 1
+                update.last_error = error_text(e)
+                if isinstance(e, PrerequisiteFailed) or update.attempts >= MAX_ATTEMPTS:
+                    logger.error("Dropping update %s of domain %s after %d attempts: %s" % (
+                                 update.pk, locked.name, update.attempts, update.last_error))
+                    update.delete()
+                    Client.objects.filter(domain=locked).update(last_ipv4=None, last_ipv6=None)
+                    # Unknown serial makes next synchronization transfer whole zone
+                    ZoneSyncState.objects.filter(domain=locked).update(serial=None, next_check=timezone.now())
+                    dropped = True
+                else:
+                    delay = retry_delay(update.attempts)
+                    logger.warning("Update %s of domain %s failed, retrying in %d seconds: %s" % (
+                                   update.pk, locked.name, delay, update.last_error))
+                    update.next_attempt = timezone.now() + timedelta(seconds=delay)
+                    update.save(update_fields=['attempts', 'last_error', 'next_attempt'])
+            else:
+                update.delete()
+                sent += 1
+        if dropped:
+            synchronize(domain)
+        if failed:
+            return sent
+
+
+class OutboxWorker(object):
+    """
+    Send queued updates of domains concurrently on a bounded thread pool.
+    Updates of one domain are always sent one at a time.
+    """
+
+    def __init__(self, parallel=4):
+        self.executor = ThreadPoolExecutor(max_workers=parallel)
+
+    def drain(self):
+        """
+        Send updates of all domains having updates due
+        :return: number of updates sent
+        """
+        start = time.time()
+        domains = Domain.objects.filter(updates__next_attempt__lte=timezone.now()).distinct()
+        futures = [self.executor.submit(self._send_pending, domain) for domain in domains]
+        sent = sum(future.result() for future in futures)
+        if sent:
+            logger.info("Sent %d updates of %d domains in %.3f seconds" % (sent, len(futures), time.time() - start))
+        return sent
+
+    def _send_pending(self, domain):
+        try:
+            return send_pending(domain)
+        except Exception:
+            logger.exception("Failed to send updates of domain %s" % domain.name)
+            return 0
+        finally:
+            close_old_connections()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,62 @@
+"""
+Token bucket rate limiting of dyndns updates.
+
+Buckets are keyed by hashed secret and source address and hold up to
+DYNDNS_RATE_LIMIT_BURST requests, refilled by DYNDNS_RATE_LIMIT_RATE
+requests per second. State is kept in Django cache, the host-local cache
+configured in settings is shared by all worker processes. Buckets are
+read and written without locking, so requests of a client handled at the
+same moment may all take the same token and pass over the burst.
+"""
+
+import time
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import stats
+
+
+BURST = getattr(settings, 'DYNDNS_RATE_LIMIT_BURST', 10)
+RATE = getattr(settings, 'DYNDNS_RATE_LIMIT_RATE', 0.1)
+
+PREFIX = 'dnsmanager:ratelimit:'
+
+
+def allow(pw_hash, address, now=None):
+    """
+    Take one request from bucket of client and address
+    :param pw_hash: hashed secret, see utils.hash_password
+    :param address: source address of request
+    :return: False if request should be rejected
+    """
+    if BURST <= 0:
+        return True
+    if now is None:
+        now = time.time()
+    key = PREFIX + sha1(('%s %s' % (pw_hash, address)).encode('utf-8')).hexdigest()
+    tokens, updated = cache.get(key) or (BURST, now)
+    tokens = min(BURST, tokens + (now - updated) * RATE)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    # Keep bucket until it would be full again
+    cache.set(key, (tokens, now), timeout=int((BURST - tokens) / RATE) + 1)
+    if not allowed:
+        stats.increment('dyndns_throttled')
+        stats.increment(_throttled_name(pw_hash))
+    return allowed
+
+
+def _throttled_name(pw_hash):
+    return 'throttled:%s' % sha1(pw_hash.encode('utf-8')).hexdigest()
+
+
+def throttle_counts(pw_hashes):
+    """
+    :param pw_hashes: hashed secrets of clients
+    :return: dict of hashed secret to number of rejected requests, clients without rejections are left out
+    """
+    names = dict((_throttled_name(pw_hash), pw_hash) for pw_hash in pw_hashes)
+    return dict((names[name], value) for name, value in stats.values(names).items())
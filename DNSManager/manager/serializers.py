@@ -22,6 +22,7 @@ class DomainSerializer(serializers.Serializer):
     tsig_key = models.CharField(max_length=8192, null=False, validators=[tsig_key_validator])
     tsig_type = models.CharField(max_length=8192, null=False, default="HMAC_MD5", choices=TSIG_KEY_TYPES)
     master = models.CharField(max_length=8192, null=False, help_text="DNS zone master server address", validators=[check_master])
+    max_age = models.PositiveIntegerField(default=300)
     """
     pk = serializers.IntegerField(read_only=True)
     name = serializers.CharField(required=True, allow_blank=False, max_length=128,
@@ -32,6 +33,7 @@ class DomainSerializer(serializers.Serializer):
     tsig_key = serializers.CharField(required=True, allow_blank=False, max_length=8192)
     tsig_type = serializers.CharField(required=True, allow_blank=False, max_length=8192)
     master = serializers.CharField(required=True, allow_null=False, allow_blank=False, max_length=256)
+    max_age = serializers.IntegerField(required=False, min_value=0)
 
     def create(self, validated_data):
         return Domain.objects.create(**validated_data)
@@ -43,6 +45,7 @@ class DomainSerializer(serializers.Serializer):
         instance.tsig_key = validated_data.get('tsig_key', instance.tsig_key)
         instance.tsig_type = validated_data.get('tsig_type', instance.tsig_type)
         instance.master = validated_data.get('master', instance.master)
+        instance.max_age = validated_data.get('max_age', instance.max_age)
 
         instance.save()
         return instance
@@ -59,6 +59,30 @@ WSGI_APPLICATION = 'manager.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.7/ref/settings/#databases
 
+# Rate limits and statistics are kept in cache shared by all processes of
+# this host, which must not be the database queried by every request. With
+# several hosts or many clients use memcached on localhost instead, see
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/dnsmanager_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Counters of manager/stats.py, apart from rate limit buckets which
+    # would otherwise get counters culled when the cache is full
+    'stats': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/dnsmanager_stats',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
@@ -125,6 +149,50 @@ STATIC_URL = '/static/'
 
 LOGIN_URL = '/login'
 
+# Seconds to wait for connecting to and reading from zone masters, and for
+# whole zone transfers
+DNS_CONNECT_TIMEOUT = 3
+DNS_READ_TIMEOUT = 5
+DNS_XFR_LIFETIME = 600
+# Master is not contacted for DNS_BREAKER_RESET_TIMEOUT seconds after
+# DNS_BREAKER_THRESHOLD consecutive failures
+DNS_BREAKER_THRESHOLD = 5
+DNS_BREAKER_RESET_TIMEOUT = 30
+# syncd checks domains by SOA refresh of zone, more often for zones which
+# change often, but at most every SYNC_MIN_INTERVAL and at least every
+# SYNC_MAX_INTERVAL seconds. Failures are retried after SOA retry seconds,
+# doubling up to SYNC_MAX_RETRY_INTERVAL. Checks vary randomly by SYNC_JITTER.
+SYNC_MIN_INTERVAL = 60
+SYNC_MAX_INTERVAL = 3600
+SYNC_MAX_RETRY_INTERVAL = 3600
+SYNC_JITTER = 0.1
+# Views synchronize domains whose records are older than Domain.max_age
+# in background on DNS_REFRESH_PARALLEL threads, 0 leaves it to syncd
+DNS_REFRESH_PARALLEL = 2
+
+# DNS update outbox, see manager/outbox.py
+# Failed updates are retried after OUTBOX_RETRY_DELAY seconds, doubling up to
+# OUTBOX_MAX_RETRY_DELAY. After OUTBOX_MAX_ATTEMPTS the update is dropped and
+# the domain is synchronized from master.
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_MAX_RETRY_DELAY = 600
+
+# Dyndns updates of a client are coalesced for DYNDNS_COALESCE_WINDOW seconds,
+# only the latest address is sent. See manager/dyndns.py
+DYNDNS_COALESCE_WINDOW = 10
+# Send dyndns address in its own UPDATE which requires previous address to be
+# still present on master, instead of replacing whatever is there
+DYNDNS_PREREQUISITE = False
+# Dyndns requests of a client from one address are limited to bursts of
+# DYNDNS_RATE_LIMIT_BURST requests refilled by DYNDNS_RATE_LIMIT_RATE requests
+# per second. Burst 0 disables limiting. Limits are shared by processes using
+# the same cache backend, see manager/ratelimit.py. Buckets are updated
+# without locking, so concurrent requests of a client may exceed the burst
+# by the number of requests handled at the same moment.
+DYNDNS_RATE_LIMIT_BURST = 10
+DYNDNS_RATE_LIMIT_RATE = 0.1
+
 try:
     from local_settings import *
 except ImportError:
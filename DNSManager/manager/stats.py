@@ -0,0 +1,47 @@
+"""
+Counters shared by all processes through Django cache.
+
+Counters are kept in the 'stats' cache of settings, or the default cache
+if there is none, shared by processes of the host so counters of the
+dyndns application and the web interface are seen together. Counters
+never expire. Increments are not locked, an increment made at the same
+moment by another process may be lost.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+CACHE = 'stats' if 'stats' in settings.CACHES else 'default'
+
+PREFIX = 'dnsmanager:stats:'
+
+COUNTERS = (
+    'dyndns_queued',  # Dyndns updates queued to master
+    'dyndns_nochg',  # Dyndns updates skipped because address did not change
+    'dyndns_throttled',  # Dyndns updates rejected by rate limit
+)
+
+
+def increment(name, delta=1):
+    cache = caches[CACHE]
+    key = PREFIX + name
+    # Not cache.incr, which sets the counter again with default timeout
+    cache.set(key, cache.get(key, 0) + delta, timeout=None)
+
+
+def values(names):
+    """
+    :param names: counter names
+    :return: dict of counter name to value, counters never incremented are left out
+    """
+    found = caches[CACHE].get_many([PREFIX + name for name in names])
+    return dict((key[len(PREFIX):], value) for key, value in found.items())
+
+
+def counters():
+    """
+    :return: dict of counter name to value
+    """
+    found = values(COUNTERS)
+    return dict((name, found.get(name, 0)) for name in COUNTERS)
@@ -0,0 +1,194 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+import dns.rrset
+import dnsutils
+
+from .dns_tools import apply_changes, reconcile
+from .models import Client, DNSEntryCache, Domain
+from .views import get_domain_records
+
+
+class GetDomainRecordsTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.domain = Domain.objects.create(name='example.com', tsig_key='key', master='127.0.0.1')
+        self.domain.users.add(self.user)
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def add_records(self, count):
+        DNSEntryCache.objects.bulk_create(
+            [DNSEntryCache(domain=self.domain, name='host%d' % i, type='A', data='192.0.2.%d' % (i % 250))
+             for i in range(count)])
+        for i in range(0, count, 10):
+            Client.objects.create(domain=self.domain, name='host%d' % i, secret='secret%d' % i)
+
+    def fetch(self):
+        return [(entry.fqdn, entry.domain.fqdn) for entry in get_domain_records(self.request, self.domain)]
+
+    def test_client_names_excluded(self):
+        self.add_records(20)
+        names = set(entry.name for entry in get_domain_records(self.request, self.domain))
+        self.assertEqual(len(names), 18)
+        self.assertNotIn('host0', names)
+        self.assertNotIn('host10', names)
+        self.assertIn('host1', names)
+
+    def test_query_count_independent_of_zone_size(self):
+        self.add_records(10)
+        # Groups of user and records with their domain
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.fetch()), 9)
+        DNSEntryCache.objects.bulk_create(
+            [DNSEntryCache(domain=self.domain, name='big%d' % i, type='A', data='192.0.2.1') for i in range(1000)])
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.fetch()), 1009)
+
+    def test_other_users_see_nothing(self):
+        self.add_records(10)
+        self.request.user = User.objects.create_user('other')
+        self.assertEqual(list(get_domain_records(self.request, self.domain)), [])
+
+
+class AddDomainTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.client.force_login(self.user)
+
+    @mock.patch('manager.views.synchronize')
+    def test_max_age_defaults_when_not_given(self, synchronize):
+        response = self.client.post('/domains/add', {
+            'name': 'example.com',
+            'comment': 'Test domain',
+            'master': '127.0.0.1',
+            'tsig_key': 'example.com. IN KEY 512 3 157 c2VjcmV0c2VjcmV0c2VjcmV0c2VjcmV0',
+            'tsig_type': 'HMAC_MD5',
+        })
+        self.assertRedirects(response, '/domains/example.com', fetch_redirect_response=False)
+        domain = Domain.objects.get(name='example.com')
+        self.assertEqual(domain.max_age, 300)
+        self.assertEqual(list(domain.users.all()), [self.user])
+        synchronize.assert_called_once_with(domain)
+
+
+class AddressCacheTest(SimpleTestCase):
+
+    def resolve(self, routable):
+        answers = {'AAAA': ['2001:db8::53'], 'A': ['192.0.2.53']}
+        resolver = mock.Mock()
+        resolver.query.side_effect = lambda name, rdtype: mock.Mock(
+            rrset=mock.Mock(ttl=600), __iter__=lambda self: iter(mock.Mock(address=x) for x in answers[rdtype]))
+        cache = dnsutils.AddressCache(refresh=False)
+        cache._resolver = resolver
+        with mock.patch('dnsutils._routable', side_effect=routable):
+            return cache.get('ns.example.com')
+
+    def test_ipv6_first_when_routable(self):
+        self.assertEqual(self.resolve(lambda address: True), ['2001:db8::53', '192.0.2.53'])
+
+    def test_ipv4_first_without_ipv6_route(self):
+        self.assertEqual(self.resolve(lambda address: ':' not in address), ['192.0.2.53', '2001:db8::53'])
+
+
+def _soa(serial):
+    return ('', 300, 'IN', 'SOA', 'ns1 hostmaster %d 3600 600 86400 300' % serial)
+
+
+class CachedRecordsTestCase(TestCase):
+
+    def setUp(self):
+        self.domain = Domain.objects.create(name='example.com', tsig_key='key', master='127.0.0.1')
+        self.records = [_soa(1), ('www', 300, 'IN', 'A', '192.0.2.1'), ('www', 300, 'IN', 'A', '192.0.2.2'),
+                        ('mail', 300, 'IN', 'MX', '10 mx')]
+
+    def cached(self):
+        return sorted(DNSEntryCache.objects.filter(domain=self.domain).values_list(
+            'name', 'ttl', 'record_class', 'type', 'data'))
+
+
+class ReconcileTest(CachedRecordsTestCase):
+
+    def test_repeated_reconcile_changes_nothing(self):
+        result = reconcile(self.domain, self.records)
+        self.assertEqual((result.added, result.removed, result.unchanged), (4, 0, 0))
+        pks = set(DNSEntryCache.objects.values_list('pk', flat=True))
+        for _ in range(2):
+            result = reconcile(self.domain, iter(self.records))
+            self.assertEqual((result.added, result.removed, result.unchanged), (0, 0, 4))
+        self.assertEqual(set(DNSEntryCache.objects.values_list('pk', flat=True)), pks)
+        self.assertEqual(self.cached(), sorted(self.records))
+
+    def test_changed_records_replaced(self):
+        reconcile(self.domain, self.records)
+        records = [_soa(2), self.records[1], ('www', 600, 'IN', 'A', '192.0.2.2'), ('ftp', 300, 'IN', 'CNAME', 'www')]
+        result = reconcile(self.domain, records)
+        self.assertEqual((result.added, result.removed, result.unchanged), (3, 3, 1))
+        self.assertEqual(self.cached(), sorted(records))
+
+    def test_duplicates_and_skipped_types_dropped(self):
+        reconcile(self.domain, self.records)
+        DNSEntryCache.objects.create(domain=self.domain, name='www', ttl=300, record_class='IN', type='A',
+                                     data='192.0.2.1')
+        result = reconcile(self.domain, self.records + [self.records[1], ('www', 300, 'IN', 'RRSIG', 'sig')])
+        self.assertEqual((result.added, result.removed, result.unchanged), (0, 1, 4))
+        self.assertEqual(self.cached(), sorted(self.records))
+
+
+class ApplyChangesTest(CachedRecordsTestCase):
+
+    def test_net_changes_applied(self):
+        reconcile(self.domain, self.records)
+        deleted = {_soa(1), self.records[2], self.records[3]}
+        added = {_soa(3), ('www', 300, 'IN', 'A', '192.0.2.3'), ('mail', 300, 'IN', 'MX', '20 mx')}
+        result = apply_changes(self.domain, deleted, added)
+        self.assertEqual((result.added, result.removed), (3, 3))
+        self.assertEqual(self.cached(), sorted([self.records[1]] + list(added)))
+
+    def test_repeated_changes_change_nothing(self):
+        reconcile(self.domain, self.records)
+        deleted = {self.records[2]}
+        added = {('www', 300, 'IN', 'A', '192.0.2.3')}
+        apply_changes(self.domain, deleted, added)
+        result = apply_changes(self.domain, deleted, added)
+        self.assertEqual((result.added, result.removed, result.unchanged), (0, 0, 4))
+        self.assertEqual(self.cached(), sorted([_soa(1), self.records[1], self.records[3]] + list(added)))
+
+
+class IxfrTest(SimpleTestCase):
+
+    def transfer(self, *messages):
+        """
+        :param messages: lists of (name, ttl, class, type, data) tuples answered by master
+        """
+        answers = [mock.Mock(answer=[dns.rrset.from_text(*record) for record in records]) for records in messages]
+        with mock.patch('dns.query.xfr', return_value=iter(answers)):
+            return dnsutils.ixfr('192.0.2.53', dnsutils.TSIGKey({}, None), None, 'example.com.', 1)
+
+    def test_up_to_date(self):
+        self.assertEqual(self.transfer([_soa(1)]), (1, False, set(), set()))
+
+    def test_net_changes_of_several_sequences(self):
+        a1, a2, a3 = [('www', 300, 'IN', 'A', '192.0.2.%d' % i) for i in (1, 2, 3)]
+        mx = ('@', 300, 'IN', 'MX', '10 mx')
+        diff = self.transfer(
+            [_soa(4), _soa(1), a1, _soa(2), a2],
+            # Added and deleted again, deleted and added again
+            [_soa(2), a2, mx, _soa(3), a3, mx],
+            [_soa(3), a3, _soa(4), a2, _soa(4)])
+        self.assertEqual(diff.serial, 4)
+        self.assertFalse(diff.full)
+        self.assertEqual(diff.deleted, {_soa(1), a1})
+        self.assertEqual(diff.added, {_soa(4), a2})
+
+    def test_whole_zone_answered(self):
+        www = ('www', 300, 'IN', 'A', '192.0.2.1')
+        diff = self.transfer([_soa(5), www], [('mail', 300, 'IN', 'MX', '10 mx'), _soa(5)])
+        self.assertEqual(diff.serial, 5)
+        self.assertTrue(diff.full)
+        self.assertEqual(diff.deleted, set())
+        self.assertEqual(diff.added, {_soa(5), www, ('mail', 300, 'IN', 'MX', '10 mx')})
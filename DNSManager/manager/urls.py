@@ -32,6 +32,7 @@ urlpatterns = [
     re_path(r'^dyndns/edit/(?P<id>[0-9]+)/secret$', manager.views.edit_dyndns_secret, name="edit_dyndns_secret"),
     re_path(r'^dyndns/add/(?P<name>[a-zA-Z0-9\.\-]+)$', manager.views.add_dyndns, name="add_dyndns"),
     re_path(r'^api/update/(?P<secret>[a-zA-Z0-9]+)$', manager.views.update, name="api_update"),
+    re_path(r'^nic/update$', manager.views.nic_update, name="nic_update"),
     re_path(r'^user/reset_password/', include('password_reset.urls')),
     path('admin/', admin.site.urls),
 
@@ -44,5 +45,6 @@ urlpatterns = [
         re_path(r'^rest/v1/domains/(?P<domain_id>[0-9]+)/records/(?P<pk>[0-9]+)$', manager_views.RecordDetail.as_view()),
         re_path(r'^rest/v1/domains/(?P<domain_id>[0-9]+)/dyndns/?$', manager_views.DynDNSList.as_view()),
         re_path(r'^rest/v1/domains/(?P<domain_id>[0-9]+)/dyndns/(?P<pk>[0-9]+)/?$', manager_views.DynDNSClient.as_view()),
+        re_path(r'^rest/v1/stats/?$', manager_views.Stats.as_view(), name="api_stats"),
     )
 )
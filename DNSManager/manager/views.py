@@ -1,4 +1,3 @@
-from datetime import datetime, timedelta
 from django.contrib import messages
 from django.contrib.auth import logout, authenticate
 from django.contrib.auth.decorators import login_required
@@ -6,7 +5,7 @@ from django.contrib.auth import login
 from django.urls import reverse
 from django.shortcuts import redirect, render
 from django.template import RequestContext
-from django.http import JsonResponse, HttpResponseRedirect, Http404, HttpRequest, HttpResponse
+from django.http import JsonResponse, HttpResponseRedirect, Http404, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.decorators import api_view
@@ -16,10 +15,14 @@ from rest_framework.views import APIView
 from rest_framework import permissions
 
 from manager.serializers import DomainSerializer, DNSEntryCacheSerializer, DynDNSSerializer, DynDNSSecretSerializer
-from .models import Client, Domain, TSIG_KEY_TYPES, DNSEntryCache
+from .models import Client, Domain, TSIG_KEY_TYPES, DNSEntryCache, DNSUpdate, PendingAddress
 from .forms import *
+from .dns_tools import SYNC_ERRORS, error_text, refresher, revalidate, synchronize
+from . import dyndns, outbox, ratelimit, stats
 from utils import hash_password, gen_password
 from django.db import transaction
+from django.db.models import Subquery
+import base64
 import socket
 from dns.exception import DNSException
 import logging
@@ -50,20 +53,15 @@ def login_page(request):
 
 
 def get_domain_records(request, domain):
-    try:
-        synchronize(domain)
-    except:
-        if isinstance(request, HttpRequest):
-            messages.error(request, "Cannot refresh dns-entries from server")
-
-    entries = []
-
-    for entry in DNSEntryCache.user_objects(request.user).filter(domain=domain).all():
-        try:
-            domain.client_set.get(name=entry.name)
-        except Client.DoesNotExist:
-            entries.append(entry)
-    return entries
+    """
+    Records of domain which are not managed by dyndns clients
+    Groups of user are read when the queryset is created, records with
+    their domain in one query when it is evaluated, whatever the zone size.
+    :return: queryset
+    """
+    clients = Client.objects.filter(domain=domain).values('name')
+    return DNSEntryCache.user_objects(request.user).filter(domain=domain).exclude(
+        name__in=Subquery(clients)).select_related('domain')
 
 
 @login_required(login_url='/login')
@@ -103,7 +101,8 @@ def show_domain(request, name):
         raise Http404
 
     entries = get_domain_records(request, domain)
-    return render(request, 'manager/show_domain.html', {'domain': domain, 'static_entries': entries})
+    return render(request, 'manager/show_domain.html', {'domain': domain, 'static_entries': entries,
+                                                        'cache': revalidate(domain)})
 
 
 @login_required
@@ -115,6 +114,11 @@ def add_domain(request):
             domain = f.save()
             domain.users.add(request.user)
             domain.save()
+            try:
+                synchronize(domain)
+            except SYNC_ERRORS as e:
+                logger.warning("Initial synchronization of domain %s failed: %s" % (domain.name, error_text(e)))
+                messages.error(request, "Cannot fetch dns-entries from server")
             messages.success(request, "Successfully added domain %s" % (f.cleaned_data['name']))
             return redirect('show_domain', domain.name)
     else:
@@ -136,14 +140,6 @@ def edit_dyndns(request, id):
         else:
             messages.error(request, "Failed to update details")
 
-    # Fetch and show also associated entries
-    try:
-        synchronize(client.domain, True)
-        messages.success(request, "Successfully updated cache")
-    except:
-        messages.error(request, "Cannot refresh dns-entries from server")
-
-
     records = []
 
     for entry in DNSEntryCache.user_objects(request.user).filter(domain=client.domain).all():
@@ -167,13 +163,6 @@ def edit_dyndns_secret(request, id):
         url += "s"
     url += "://%s%s" % (request.get_host(), reverse('api_update', args=(new_secret,)))
 
-    # Fetch and show also associated entries
-    try:
-        synchronize(client.domain, True)
-        messages.success(request, "Successfully updated cache")
-    except:
-        messages.error(request, "Cannot refresh dns-entries from server")
-
     records = []
 
     for entry in DNSEntryCache.user_objects(request.user).filter(domain=client.domain).all():
@@ -238,10 +227,13 @@ def synchronize_domain(request, domain):
         raise Http404
 
     try:
-        synchronize(domain, True)
-        messages.success(request, "Successfully updated cache")
-    except:
-        messages.error(request, "Cannot refresh dns-entries from server")
+        if synchronize(domain, True) is None and domain.updates.exists():
+            messages.info(request, "Changes are still being sent to server, cache is updated after that")
+        else:
+            messages.success(request, "Successfully updated cache")
+    except SYNC_ERRORS as e:
+        logger.warning("Synchronization of domain %s failed: %s" % (domain.name, error_text(e)))
+        messages.error(request, "Cannot refresh dns-entries from server, showing cached entries")
 
 
     return redirect('show_domain', domain.name)
@@ -257,8 +249,9 @@ def synchronize_dyndns(request, id):
     try:
         synchronize(client.domain, True)
         messages.success(request, "Successfully updated cache")
-    except:
-        messages.error(request, "Cannot refresh dns-entries from server")
+    except SYNC_ERRORS as e:
+        logger.warning("Synchronization of domain %s failed: %s" % (client.domain.name, error_text(e)))
+        messages.error(request, "Cannot refresh dns-entries from server, showing cached entries")
 
     return redirect('edit_dyndns', client.pk)
 
@@ -270,11 +263,6 @@ def add_static(request, domain):
     except Domain.DoesNotExist:
         raise Http404
 
-    try:
-        synchronize(domain)
-    except:
-        messages.error(request, "Cannot refresh dns-entries from server")
-
     form = None
 
     response_data = {
@@ -296,13 +284,12 @@ def add_static(request, domain):
                 messages.error(request, str(e))
                 return render(request, 'manager/add_static.html', response_data)
 
-            # Save data
-            entry = form.save()
-
-            # Add record also to dns-server
-            dnsutils.doUpdate(domain.master, domain.tsig_key, domain.tsig_type, domain.name, False,
-                              'add', str(form.cleaned_data['ttl']), form.cleaned_data['type'],
-                              entry.fqdn, form.cleaned_data['data'])
+            # Save data and queue record to dns-server
+            with transaction.atomic():
+                entry = form.save()
+                changes = domain.changeset()
+                changes.add(entry.fqdn, entry.ttl, entry.type, entry.data)
+                outbox.enqueue(domain, changes)
 
             messages.success(request, "Successfully added entry %s %s %s %s" % (
                              entry.fqdn, entry.ttl, entry.type, entry.data))
@@ -355,25 +342,16 @@ def edit_static(request, domain, entry):
                 messages.error(request, str(e))
                 return render(request, 'manager/add_static.html', response_data)
 
-            entry = form.save()
-
-            # Add to real dns
-
-            try:
-                dnsutils.doUpdate(domain.master, domain.tsig_key, domain.tsig_type, domain.name, False,
-                              'delete', str(old_instance.ttl), old_instance.type,
-                              old_instance.fqdn, old_instance.data)
-                dnsutils.doUpdate(domain.master, domain.tsig_key, domain.tsig_type, domain.name, False,
-                              'add', str(form.cleaned_data['ttl']), form.cleaned_data['type'],
-                              entry.fqdn, form.cleaned_data['data'])
-                messages.success(request, "Successfully updated entry %s %s %s %s" % (
+            # Save data and queue change to dns-server
+            with transaction.atomic():
+                entry = form.save()
+                changes = domain.changeset()
+                changes.delete(old_instance.fqdn, old_instance.type, old_instance.data)
+                changes.add(entry.fqdn, entry.ttl, entry.type, entry.data)
+                outbox.enqueue(domain, changes)
+            messages.success(request, "Successfully updated entry %s %s %s %s" % (
                              entry.fqdn, entry.ttl, entry.type, entry.data))
 
-            except Exception:
-                messages.error(request, "Cannot update values to DNS-server.")
-                transaction.rollback()
-
-
             return redirect('show_domain', domain.name)
 
     else:
@@ -403,110 +381,113 @@ def delete_static(request, domain, entry):
         form = ConfirmDeleteForm(request.POST)
         print(form['confirmed'])
         if form.is_valid():
-            dnsutils.doUpdate(domain.master, domain.tsig_key, domain.tsig_type, domain.name, False,
-                              'delete', str(instance.ttl), instance.type,
-                              instance.fqdn, instance.data)
-            instance.delete()
+            with transaction.atomic():
+                changes = domain.changeset()
+                changes.delete(instance.fqdn, instance.type, instance.data)
+                outbox.enqueue(domain, changes)
+                instance.delete()
             messages.success(request, "Successfully deleted entry %s %s %s %s" % (
                              instance.fqdn, instance.ttl, instance.type, instance.data))
             return redirect('show_domain', domain.name)
     return render(request, 'manager/delete_static.html', {'domain': domain, 'entry': instance, 'form': form})
 
 
-def synchronize(domain, force=False):
-    """
-    Synchronize domain dns-entries to database.
-    Synchronize only if more than 60 seconds from previous.
-    :param domain: Domain object
-    :return: None
-    """
-
-    if not force:
-        try:
-            DNSEntryCache.objects.get(domain=domain, timestamp__gt=(datetime.now() - timedelta(seconds=60)))
-            return
-        except DNSEntryCache.DoesNotExist:
-            pass
-        except DNSEntryCache.MultipleObjectsReturned:
-            pass
-
-    zone = dnsutils.axfr(domain.master, domain.tsig_key,
-                         domain.tsig_type, domain.fqdn)
-
-    current_entries = list(DNSEntryCache.objects.filter(domain=domain).all())
-
-    for name, rdataset in zone.iterate_rdatasets():
-        name = name.to_text()
-        # There is maybe better way to do it, but dnspython is complex...
-        # 60 IN A 1.2.3.4
-        for line in rdataset.to_text().splitlines():
-            (ttl, rclass, rtype, rdata) = line.split(None, 3)
-            # Skip dnssec records for now.
-            if rtype in ['RRSIG', 'TYPE65534', 'DNSKEY', 'NSEC']:
-                continue
-            rtype = rtype.strip()
-            rdata = rdata.strip()
-            rclass = rclass.strip()
-            ttl = int(ttl)
-            if name == "@":
-                name = ""
-            found = False
-            id = 0
-            for entry in current_entries:
-                if entry.name == name and entry.ttl == ttl and entry.type == rtype and entry.data == rdata and entry.record_class == rclass:
-                    found = True
-                    del current_entries[id]
-                    break
-                id += 1
-            if not found:
-                entry = DNSEntryCache()
-                entry.name = name
-                entry.domain = domain
-                entry.ttl = ttl
-                entry.record_class = rclass.strip()
-                entry.type = rtype.strip()
-                entry.data = rdata.strip()
-                entry.save()
-
-    for entry in current_entries:
-        # Remove entries not found any more
-        entry.delete()
-
-
 def update(request, secret):
     """
     Update dns record.
-
-    TODO:
-    - query ttl
-    - query records from master instead of nearest resolver
+    Address is stored and sent to master later by outbox worker, latest
+    address within coalescing window wins. Unchanged address is not sent.
     """
     pw_hash = hash_password(secret)
     client_ip = request.META['REMOTE_ADDR']
+    if not ratelimit.allow(pw_hash, client_ip):
+        return JsonResponse({'status': 'ERROR', 'msg': 'Too many requests'}, status=429)
     client_type = 'A'
     if ':' in client_ip:
         client_type = 'AAAA'
-    try:
-        client = Client.objects.get(secret=pw_hash)
-    except Client.DoesNotExist:
+    client = Client.objects.select_related('domain').filter(secret=pw_hash).order_by('pk').first()
+    if client is None:
         return JsonResponse({'status': 'ERROR', 'msg':'Invalid secret'})
     logging.info("Updating %s to %s" % (client.fqdn, client_ip))
     try:
-        for address in dnsutils.do_resolve(client.fqdn, client_type, client.domain.master):
-            dnsutils.doUpdate(client.domain.master, client.domain.tsig_key,
-                                  client.domain.tsig_type, client.domain.fqdn,
-                                  False, 'delete', '60', client_type, client.fqdn, address)
+        queued = dyndns.record(client, client_type, client_ip)
     except Exception as e:
         logger.exception(e)
         return JsonResponse({'status': 'ERROR', 'msg':'Internal error'})
+    if not queued:
+        return JsonResponse({'status': 'NOCHG', 'msg': '%s address is already %s' % (client.fqdn, client_ip)})
+    return JsonResponse({'status': 'QUEUED', 'msg': 'Update of %s address to %s queued' % (client.fqdn, client_ip)},
+                        status=202)
+
+
+def nic_update(request):
+    """
+    dyndns2 compatible update of several hostnames and both address families.
+
+    Password of HTTP basic authentication is the dyndns secret and
+    hostnames must belong to clients having that secret, username is
+    ignored. Addresses are taken from myip and myipv6 parameters, or from
+    the request address if neither is given. Changes are coalesced into
+    one UPDATE per zone like other dyndns updates.
+    """
+    secret = basic_auth_password(request)
+    pw_hash = hash_password(secret) if secret else None
+    if pw_hash and not ratelimit.allow(pw_hash, request.META['REMOTE_ADDR']):
+        return HttpResponse('911\n', content_type='text/plain', status=429)
+    # Several clients may share a secret to be updated in one request
+    found = list(Client.objects.select_related('domain').filter(secret=pw_hash).order_by('pk')) if pw_hash else []
+    if not found:
+        response = HttpResponse('badauth\n', content_type='text/plain', status=401)
+        response['WWW-Authenticate'] = 'Basic realm="DNSManager"'
+        return response
+
+    hostnames = [x.strip().rstrip('.').lower() for x in request.GET.get('hostname', '').split(',') if x.strip()]
+    if not hostnames:
+        return HttpResponse('notfqdn\n', content_type='text/plain')
+
     try:
-        dnsutils.doUpdate(client.domain.master, client.domain.tsig_key,
-                          client.domain.tsig_type, client.domain.fqdn, False,
-                          'update', '60', client_type, client.fqdn, client_ip)
-    except Exception as e:
-        logger.exception(e)
-        return JsonResponse({'status': 'ERROR', 'msg':'Internal error'})
-    return JsonResponse({'status': 'OK', 'msg': 'Successfully updated %s address to %s' % (client.fqdn, client_ip)})
+        addresses = dyndns.parse_addresses(request.GET.get('myip'), request.GET.get('myipv6'))
+        if not addresses:
+            addresses = dyndns.parse_addresses(request.META['REMOTE_ADDR'])
+    except ValueError:
+        return HttpResponse('911\n' * len(hostnames), content_type='text/plain')
+
+    by_name = dict((client.fqdn.rstrip('.').lower(), client) for client in found)
+    lines = []
+    for hostname in hostnames:
+        client = by_name.get(hostname)
+        if client is None:
+            lines.append('nohost')
+            continue
+        changed = False
+        try:
+            for type, address in addresses.items():
+                if dyndns.record(client, type, address):
+                    changed = True
+        except Exception as e:
+            logger.exception(e)
+            lines.append('911')
+            continue
+        lines.append('%s %s' % ('good' if changed else 'nochg', ' '.join(addresses.values())))
+    logger.info("dyndns2 update of %s to %s: %s" % (
+                ','.join(hostnames), ','.join(addresses.values()), ','.join(lines)))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain')
+
+
+def basic_auth_password(request):
+    """
+    :return: password from HTTP basic authentication header or None
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'basic':
+        return None
+    try:
+        credentials = base64.b64decode(auth[1]).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if ':' not in credentials:
+        return None
+    return credentials.split(':', 1)[1]
 
 
 def delete_client(client):
@@ -516,14 +497,12 @@ def delete_client(client):
     :param client:
     :return:
     """
-    synchronize(client.domain)
-
-    for entry in DNSEntryCache.objects.filter(domain=client.domain, name=client.name).all():
-
-        dnsutils.doUpdate(entry.domain.master, entry.domain.tsig_key,
-                                  client.domain.tsig_type, entry.domain.fqdn,
-                                  False, 'delete', str(entry.ttl), entry.type, entry.fqdn, entry.data)
-        entry.delete()
+    # Whole name is deleted, cache may not have address of an update still queued
+    changes = client.domain.changeset()
+    changes.delete(client.fqdn)
+    with transaction.atomic():
+        outbox.enqueue(client.domain, changes)
+        DNSEntryCache.objects.filter(domain=client.domain, name=client.name).delete()
 
 
 @login_required
@@ -546,6 +525,21 @@ class JSONResponse(HttpResponse):
         super(JSONResponse, self).__init__(content, **kwargs)
 
 
+def cache_headers(response, domain):
+    """
+    Tell age of cached records and whether they are stale because master is unavailable.
+    Expired records are refreshed in background, see dns_tools.revalidate.
+    """
+    state = revalidate(domain)
+    if state.stale:
+        response['X-DNS-Stale'] = '1'
+    if state.last_sync:
+        response['X-DNS-Last-Sync'] = state.last_sync.isoformat()
+    if state.age is not None:
+        response['X-DNS-Cache-Age'] = '%d' % state.age
+    return response
+
+
 class DomainList(APIView):
 
     def get(self, request, format=None):
@@ -657,30 +651,25 @@ class RecordList(APIView):
 
     def get(self, request, domain_id, format=None):
         domain = self.get_domain(domain_id)
-        try:
-            synchronize(domain)
-        except (DNSException, dnsutils.DynDNSException):
-            # TODO: inform user somehow
-            pass
         records = get_domain_records(request, domain)
         serializer = DNSEntryCacheSerializer(records, many=True)
-        return JSONResponse(serializer.data)
+        return cache_headers(JSONResponse(serializer.data), domain)
 
     def post(self, request, domain_id, format=None):
         domain = self.get_domain(domain_id)
         data = JSONParser().parse(request)
         serializer = DNSEntryCacheSerializer(data=data)
         if serializer.is_valid():
-            record = serializer.save(domain=domain)
             try:
-                dnsutils.doUpdate(domain.master, domain.tsig_key, domain.tsig_type,
-                                  domain.name, False, 'add', str(record.ttl),
-                                  record.type, record.fqdn, record.data)
+                with transaction.atomic():
+                    record = serializer.save(domain=domain)
+                    changes = domain.changeset()
+                    changes.add(record.fqdn, record.ttl, record.type, record.data)
+                    outbox.enqueue(domain, changes)
             except (DNSException, dnsutils.DynDNSException):
-                logger.exception("Failed to update value to dns, domain %s" % record.domain.name)
-                transaction.rollback()
-                return JSONResponse({"detail": 'Cannot update values to DNS-server'},
-                                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                logger.exception("Invalid record for domain %s" % domain.name)
+                return JSONResponse({"detail": 'Invalid record data'},
+                                    status=status.HTTP_400_BAD_REQUEST)
             return JSONResponse(serializer.data, status=status.HTTP_201_CREATED)
         return JSONResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -692,10 +681,6 @@ class RecordDetail(APIView):
 
     def get_object(self, domain_id, pk):
         domain = self.get_domain(domain_id)
-        try:
-            synchronize(domain)
-        except (DNSException, dnsutils.DynDNSException):
-            logger.exception("Failed to synchronize domain %s" % domain.name)
         try:
             return DNSEntryCache.user_objects(self.request.user).get(pk=pk, domain=domain)
         except DNSEntryCache.DoesNotExist:
@@ -710,42 +695,58 @@ class RecordDetail(APIView):
     def get(self, request, domain_id, pk, format=None):
         record = self.get_object(domain_id, pk)
         serializer = DNSEntryCacheSerializer(record)
-        return JSONResponse(serializer.data)
+        return cache_headers(JSONResponse(serializer.data), record.domain)
 
     def put(self, request, domain_id, pk, format=None):
         record = self.get_object(domain_id, pk)
+        old_fqdn, old_type, old_data = record.fqdn, record.type, record.data
         data = JSONParser().parse(request)
         serializer = DNSEntryCacheSerializer(record, data=data)
         if serializer.is_valid():
-            new_instance = serializer.save()
-
             try:
-                dnsutils.doUpdate(record.domain.master, record.domain.tsig_key, record.domain.tsig_type,
-                              record.domain.name, False, 'delete', str(record.ttl), record.type,
-                              record.fqdn, record.data)
-                dnsutils.doUpdate(new_instance.domain.master, new_instance.domain.tsig_key, new_instance.domain.tsig_type,
-                              new_instance.domain.name, False, 'add', str(new_instance.ttl),
-                              new_instance.type, new_instance.fqdn, new_instance.data)
+                with transaction.atomic():
+                    new_instance = serializer.save()
+                    changes = new_instance.domain.changeset()
+                    changes.delete(old_fqdn, old_type, old_data)
+                    changes.add(new_instance.fqdn, new_instance.ttl, new_instance.type, new_instance.data)
+                    outbox.enqueue(new_instance.domain, changes)
             except (DNSException, dnsutils.DynDNSException):
-                logger.exception("Failed to update value to dns, domain %s" % record.domain.name)
-                transaction.rollback()
-                return JSONResponse({"detail": 'Cannot update values to DNS-server'},
-                                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                logger.exception("Invalid record for domain %s" % record.domain.name)
+                return JSONResponse({"detail": 'Invalid record data'},
+                                    status=status.HTTP_400_BAD_REQUEST)
             return JSONResponse(serializer.data)
         return JSONResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, domain_id, pk, format=None):
         record = self.get_object(domain_id, pk)
 
-        try:
-            dnsutils.doUpdate(record.domain.master, record.domain.tsig_key, record.domain.tsig_type,
-                              record.domain.name, False, 'delete', str(record.ttl), record.type,
-                              record.fqdn, record.data)
-        except (DNSException, dnsutils.DynDNSException):
-                logger.exception("Failed to update value to dns, domain %s" % record.domain.name)
-                transaction.rollback()
-                return JSONResponse({"detail": 'Cannot delete record from DNS-server'},
-                                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        record.delete()
+        with transaction.atomic():
+            changes = record.domain.changeset()
+            changes.delete(record.fqdn, record.type, record.data)
+            outbox.enqueue(record.domain, changes)
+            record.delete()
 
         return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+
+class Stats(APIView):
+    """
+    Counters and queue lengths for monitoring
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        secrets = dict((secret, (name, domain)) for (secret, name, domain) in
+                       Client.objects.values_list('secret', 'name', 'domain__name'))
+        throttled = ratelimit.throttle_counts(secrets)
+        return JSONResponse({
+            'counters': stats.counters(),
+            'throttled': dict(('%s.%s.' % secrets[pw_hash], count) for pw_hash, count in throttled.items()),
+            'outbox': DNSUpdate.objects.count(),
+            'pending_addresses': PendingAddress.objects.count(),
+            'keyrings': dnsutils.keyrings.stats(),
+            'addresses': dnsutils.addresses.stats(),
+            'zones': dnsutils.zones.stats(),
+            'breakers': dnsutils.breakers.stats(),
+            'refresh': refresher.stats(),
+        })